@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2023  Anders Håål
+
+    This file is part of fortigate-exporter-discovery.
+
+    fortigate-exporter-discovery is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    fortigate-exporter-discovery is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fortigate-exporter-discovery.  If not, see <http://www.gnu.org/licenses/>.
+
+    Compare the columnar metrics engine with the FmgMetrics/generate_latest path.
+
+    python -m benchmarks.bench_metrics [devices ...]
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks.synthetic import fortigates
+from fmg_discovery.fmg_collector import FmgCollector
+from fmg_discovery.fmg_metrics import FmgMetricColumns, generate_metrics
+from fmg_discovery.http_service_discovery import generate_latest
+
+
+def best_of(function, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench(devices: int, repeat: int):
+    fws = fortigates(devices)
+
+    def labels_base():
+        return generate_latest(asyncio.run(FmgCollector(fws).collect()))
+
+    def columnar():
+        return generate_metrics([FmgMetricColumns(adom_fws) for adom_fws in fws.values()])
+
+    labels_base_time = best_of(labels_base, repeat)
+    columnar_time = best_of(columnar, repeat)
+    print(f"devices={devices} labels_base={labels_base_time * 1000:.1f}ms columnar={columnar_time * 1000:.1f}ms "
+          f"speedup={labels_base_time / columnar_time:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the /metrics rendering')
+    parser.add_argument('devices', nargs='*', type=int, default=[10000, 50000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    for count in args.devices:
+        bench(count, args.repeat)
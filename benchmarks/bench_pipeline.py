@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2023  Anders Håål
+
+    This file is part of fortigate-exporter-discovery.
+
+    fortigate-exporter-discovery is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    fortigate-exporter-discovery is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fortigate-exporter-discovery.  If not, see <http://www.gnu.org/licenses/>.
+
+    Benchmark the steps of the discovery and exposition pipeline on synthetic FortiManager device rows, and compare
+    the result with a stored baseline.
+
+    python -m benchmarks.bench_pipeline [devices ...] [--output result.json] [--baseline benchmarks/baseline.json]
+    python -m benchmarks.bench_pipeline --save-baseline benchmarks/baseline.json
+
+    The times are compared relative to a calibration loop, so a baseline created on one machine can be used on
+    another. The exit code is 1 if a step is slower than the baseline by more than the tolerance.
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+from typing import Dict, Callable, Any, Optional, Tuple, List
+
+import yaml
+
+from benchmarks.synthetic import device_rows, adom_config
+from fmg_discovery import json_codec
+from fmg_discovery.fmg_metrics import FmgMetrics, FmgMetricColumns, generate_metrics
+from fmg_discovery.fw import Fortigate, fw_factory, adom_labels
+from fmg_discovery.http_service_discovery import generate_latest
+
+BASELINE_VERSION = 1
+DEFAULT_DEVICES = [100, 10000, 100000]
+# A step is only repeated until this number of seconds is spent, the large yaml dumps are slow
+MAX_STEP_SECONDS = 5.0
+# Differences smaller than this number of seconds are never a regression, to not fail on noise of fast steps
+MIN_REGRESSION_SECONDS = 0.002
+
+
+def best_of(function: Callable[[Any], Any], repeat: int, setup: Optional[Callable[[], Any]] = None) -> float:
+    """
+    The best time of running the function, the setup is run before each run and is not included in the time
+    :param function: called with the result of setup
+    :param repeat: max number of runs
+    :param setup:
+    :return: the best time in seconds
+    """
+    best = float('inf')
+    spent = 0.0
+    for _ in range(repeat):
+        argument = setup() if setup is not None else None
+        start = time.perf_counter()
+        function(argument)
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        spent += elapsed
+        if spent > MAX_STEP_SECONDS:
+            break
+    return best
+
+
+def calibrate(repeat: int = 5) -> float:
+    """
+    Time a fixed pure python workload, used to compare times from different machines
+    :return:
+    """
+    def workload(_):
+        rows = [{'name': f"fw-{index}", 'status': 'up' if index % 3 else 'down'} for index in range(100000)]
+        return sum(1 for row in rows if row['status'] == 'up')
+
+    return best_of(workload, repeat)
+
+
+def steps(devices: int) -> Dict[str, Tuple[Callable[[Any], Any], Optional[Callable[[], Any]]]]:
+    """
+    The benchmarked steps for a number of devices, as the function to time and an optional setup function
+    :param devices:
+    :return:
+    """
+    rows = device_rows(devices)
+    adoms = {adom_name: adom_config(adom_name) for adom_name in rows}
+    labels = {adom_name: adom_labels(adom) for adom_name, adom in adoms.items()}
+
+    def new_fortigates(_=None) -> Dict[str, List[Fortigate]]:
+        return {adom_name: [fw_factory(adoms[adom_name], row, labels[adom_name]) for row in adom_rows]
+                for adom_name, adom_rows in rows.items()}
+
+    fws = new_fortigates()
+    parsed = FmgMetrics(fws)
+    parsed.parse()
+    metrics_list = list(parsed.metrics())
+
+    def valid(_):
+        return [fw.valid() for adom_fws in fws.values() for fw in adom_fws]
+
+    def file_sd_entry(fresh: Dict[str, List[Fortigate]]):
+        # The entries are memoized, so new Fortigates are created by the setup for every run
+        return [fw.as_prometheus_file_sd_entry() for adom_fws in fresh.values() for fw in adom_fws]
+
+    def fmg_metrics(_):
+        transformer = FmgMetrics(fws)
+        transformer.parse()
+        return list(transformer.metrics())
+
+    def latest(_):
+        return generate_latest(metrics_list)
+
+    def columnar_metrics(_):
+        return generate_metrics([FmgMetricColumns(adom_fws) for adom_fws in fws.values()])
+
+    def sd_json(_):
+        return json_codec.dumps([fw.as_prometheus_file_sd_entry() for adom_fws in fws.values() for fw in adom_fws])
+
+    def file_sd_yaml(_):
+        return [yaml.safe_dump([fw.as_prometheus_file_sd_entry() for fw in adom_fws]) for adom_fws in fws.values()]
+
+    return {'fw_factory': (new_fortigates, None),
+            'valid': (valid, None),
+            'file_sd_entry': (file_sd_entry, new_fortigates),
+            'fmg_metrics_parse': (fmg_metrics, None),
+            'generate_latest': (latest, None),
+            'columnar_metrics': (columnar_metrics, None),
+            'sd_json': (sd_json, None),
+            'file_sd_yaml': (file_sd_yaml, None)}
+
+
+def run(device_counts: List[int], repeat: int) -> Dict[str, Any]:
+    result = {'version': BASELINE_VERSION, 'python': platform.python_version(), 'json_codec': json_codec.codec().name,
+              'calibration': calibrate(), 'results': {}}
+    for devices in device_counts:
+        for step, (function, setup) in steps(devices).items():
+            elapsed = best_of(function, repeat, setup)
+            result['results'].setdefault(step, {})[str(devices)] = elapsed
+            print(f"step={step} devices={devices} time={elapsed * 1000:.2f}ms", file=sys.stderr)
+    return result
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """
+    Compare the result with the baseline, the times are scaled with the calibration of the baseline
+    :param result:
+    :param baseline:
+    :param tolerance: the allowed slowdown as a fraction, 0.5 is 50% slower
+    :return: the regressions
+    """
+    if baseline.get('version') != BASELINE_VERSION:
+        return [f"The baseline version {baseline.get('version')} is not {BASELINE_VERSION}"]
+    # The json steps are not comparable between codecs
+    if baseline.get('json_codec') != result['json_codec']:
+        return [f"The baseline json codec {baseline.get('json_codec')} is not {result['json_codec']}, set "
+                f"FMG_DISCOVERY_JSON_CODEC or create a new baseline"]
+    scale = result['calibration'] / baseline['calibration']
+    regressions = []
+    for step, step_results in result['results'].items():
+        for devices, elapsed in step_results.items():
+            baseline_elapsed = baseline['results'].get(step, {}).get(devices)
+            if baseline_elapsed is None:
+                continue
+            expected = baseline_elapsed * scale
+            if elapsed > expected * (1 + tolerance) and elapsed - expected > MIN_REGRESSION_SECONDS:
+                regressions.append(f"step={step} devices={devices} time={elapsed * 1000:.2f}ms "
+                                   f"baseline={expected * 1000:.2f}ms slowdown={elapsed / expected:.2f}x")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the discovery and exposition pipeline')
+    parser.add_argument('devices', nargs='*', type=int, default=DEFAULT_DEVICES)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='Write the result as json to the file')
+    parser.add_argument('--baseline', help='Compare with the baseline json file')
+    parser.add_argument('--save-baseline', help='Write the result as the baseline json file', dest='save_baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='The allowed slowdown compared to the baseline, default 0.5 (50%%)')
+    args = parser.parse_args()
+
+    benchmark = run(args.devices, args.repeat)
+    print(json.dumps(benchmark, indent=2))
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as result_file:
+                json.dump(benchmark, result_file, indent=2)
+                result_file.write('\n')
+
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            failed = compare(benchmark, json.load(baseline_file), args.tolerance)
+        for regression in failed:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if failed:
+            sys.exit(1)
+        print("No regressions compared to the baseline", file=sys.stderr)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2023  Anders Håål
+
+    This file is part of fortigate-exporter-discovery.
+
+    fortigate-exporter-discovery is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    fortigate-exporter-discovery is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fortigate-exporter-discovery.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+from typing import Dict, List, Any
+
+from fmg_discovery.fmg_simulator import device_row, device_rows
+from fmg_discovery.fw import Fortigate, fw_factory, adom_labels
+
+# The device rows are the same as the FortiManager simulator
+__all__ = ['device_row', 'device_rows', 'adom_config', 'fortigates']
+
+
+def adom_config(name: str) -> Dict[str, Any]:
+    return {'name': name, 'labels': {'customer': name.lower(), 'zone': 'synthetic'},
+            'fortigate': {'token': 'synthetic-token', 'port': 44343, 'profile': 'common'}}
+
+
+def fortigates(devices: int, adoms: int = 10, seed: int = 42) -> Dict[str, List[Fortigate]]:
+    """
+    Create synthetic Fortigates spread over a number of adoms
+    """
+    fws: Dict[str, List[Fortigate]] = {}
+    for adom_name, rows in device_rows(devices, adoms, seed).items():
+        adom = adom_config(adom_name)
+        labels = adom_labels(adom)
+        fws[adom_name] = [fw_factory(adom, row, labels) for row in rows]
+    return fws
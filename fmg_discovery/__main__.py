@@ -29,9 +29,12 @@ if __name__ == "__main__":
     parser.add_argument('--server', action='store_true',
                         help='Start in http service discovery mode',
                         dest='server')
+    parser.add_argument('--watch', action='store_true',
+                        help='Run file service discovery as a daemon that refresh the files periodically',
+                        dest='watch')
     args = vars(parser.parse_args())
 
     if args['server']:
         http_service_discovery()
     else:
-        file_service_discovery()
+        file_service_discovery(watch=args['watch'])
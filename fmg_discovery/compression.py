@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2023  Anders Håål
+
+    This file is part of fortigate-exporter-discovery.
+
+    fortigate-exporter-discovery is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    fortigate-exporter-discovery is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fortigate-exporter-discovery.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import zlib
+from typing import Optional, List, Dict, Iterable
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+IDENTITY = 'identity'
+
+# The default levels, a higher level cost a lot more cpu for a few percent better ratio
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def supported_encodings() -> List[str]:
+    """
+    The supported content encodings in order of preference, zstd is only supported if zstandard is installed
+    :return:
+    """
+    if zstandard is not None:
+        return [ZSTD, GZIP]
+    return [GZIP]
+
+
+def negotiate(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    Select the content encoding to use from the Accept-Encoding header
+    :param accept_encoding: the header value like "gzip, deflate, br;q=0.5"
+    :return: the selected encoding or None if the body should not be compressed
+    """
+    if not accept_encoding:
+        return None
+
+    qualities: Dict[str, float] = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        quality = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            qualities[coding] = quality
+
+    selected = None
+    selected_quality = 0.0
+    for encoding in supported_encodings():
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > selected_quality:
+            selected = encoding
+            selected_quality = quality
+    return selected
+
+
+def compress_chunks(chunks: Iterable[bytes], encoding: str) -> List[bytes]:
+    """
+    Compress a body made of chunks without joining the chunks
+    :param chunks:
+    :param encoding:
+    :return: the compressed chunks
+    """
+    if encoding == GZIP:
+        # wbits 31 create the gzip container
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    elif encoding == ZSTD and zstandard is not None:
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    else:
+        raise ValueError(f"Not supported content encoding {encoding}")
+
+    compressed = [compressor.compress(chunk) for chunk in chunks]
+    compressed.append(compressor.flush())
+    return [chunk for chunk in compressed if chunk]
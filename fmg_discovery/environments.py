@@ -29,3 +29,14 @@ FMG_DISCOVERY_BASIC_AUTH_ENABLED = 'FMG_DISCOVERY_BASIC_AUTH_ENABLED'
 FMG_DISCOVERY_LOG_FILE = 'FMG_DISCOVERY_LOG_FILE'
 FMG_DISCOVERY_LOG_LEVEL = 'FMG_DISCOVERY_LOG_LEVEL'
 FMG_DISCOVERY_CACHE_TTL = 'FMG_DISCOVERY_CACHE_TTL'
+FMG_DISCOVERY_CACHE_JITTER = 'FMG_DISCOVERY_CACHE_JITTER'
+FMG_DISCOVERY_CACHE_MAX_STALENESS = 'FMG_DISCOVERY_CACHE_MAX_STALENESS'
+FMG_DISCOVERY_CACHE_NEGATIVE_TTL = 'FMG_DISCOVERY_CACHE_NEGATIVE_TTL'
+FMG_DISCOVERY_WATCH_INTERVAL = 'FMG_DISCOVERY_WATCH_INTERVAL'
+FMG_DISCOVERY_WATCH_JITTER = 'FMG_DISCOVERY_WATCH_JITTER'
+FMG_DISCOVERY_WATCH_MAX_BACKOFF = 'FMG_DISCOVERY_WATCH_MAX_BACKOFF'
+FMG_DISCOVERY_SNAPSHOT_FILE = 'FMG_DISCOVERY_SNAPSHOT_FILE'
+FMG_DISCOVERY_SHARD_BY = 'FMG_DISCOVERY_SHARD_BY'
+FMG_DISCOVERY_SHARDS = 'FMG_DISCOVERY_SHARDS'
+FMG_DISCOVERY_PROFILING_ENABLED = 'FMG_DISCOVERY_PROFILING_ENABLED'
+FMG_DISCOVERY_JSON_CODEC = 'FMG_DISCOVERY_JSON_CODEC'
@@ -18,20 +18,286 @@
     along with fortigate-exporter-discovery.  If not, see <http://www.gnu.org/licenses/>.
 
 """
+import asyncio
+import hashlib
 import os
-from typing import List, Dict, Any
+import random
+import signal
+import tempfile
+from typing import List, Dict, Any, Optional, Union, Set
 
 import yaml
 
-from fmg_discovery.environments import FMG_DISCOVERY_PROMETHEUS_SD_FILE_DIRECTORY, FMG_DISCOVERY_CONFIG
-from fmg_discovery.fmg_api import FMG
-from fmg_discovery.fmglogging import Log
+from fmg_discovery.environments import FMG_DISCOVERY_PROMETHEUS_SD_FILE_DIRECTORY, FMG_DISCOVERY_CONFIG, \
+    FMG_DISCOVERY_WATCH_INTERVAL, FMG_DISCOVERY_WATCH_JITTER, FMG_DISCOVERY_WATCH_MAX_BACKOFF, FMG_DISCOVERY_SHARDS, \
+    FMG_DISCOVERY_SHARD_BY
+from fmg_discovery.exceptions import FmgException
+from fmg_discovery.fmg_federation import FederatedFMG, configured_adoms, adom_key
+from fmg_discovery.fmglogging import Log, MESSAGE
+from fmg_discovery.fw import Fortigate
+from fmg_discovery.sharding import SHARD_BY_NAME, shard_hashes, partition
 
 
 log = Log(__name__)
 
+FILE_SD_SUFFIX = '.yaml'
+# The list of the files written by the writer, it do not end with the suffix so Prometheus will not pick it up
+MANIFEST_FILE = '.fmg-discovery-manifest'
 
-def file_service_discovery():
+
+class FileServiceDiscoveryWriter:
+    """
+    Write the Prometheus file service discovery files, one file per adom. A file is only written if its content
+    changed, and it is written to a temporary file that is atomically moved in place, so Prometheus never
+    read a partial file.
+    The written files are recorded in a manifest file in the directory, and only those files are removed, so other
+    files in the directory are never touched.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        # The content hash of the files written by this writer
+        self._hashes: Dict[str, str] = {}
+        # The fingerprint of the Fortigates the files was written from
+        self._fingerprints: Dict[str, str] = {}
+        # The names of the files written by this writer, also by earlier runs
+        self._written: Set[str] = self._read_manifest()
+
+    def write(self, fws: Dict[str, List[Fortigate]], adom_names: List[str],
+              fingerprints: Dict[str, str] = None) -> Dict[str, int]:
+        """
+        Write the files for the adoms in fws and remove files written for adoms that is not in adom_names.
+        Adoms in adom_names that is not in fws, e.g. failed, are left untouched.
+        :param fws: the Fortigates per adom
+        :param adom_names: all configured adoms
+        :param fingerprints: the fingerprint of the Fortigates per adom, an adom with the same fingerprint as
+        last written is not rendered again
+        :return: the number of changed, unchanged and removed files
+        """
+        fingerprints = fingerprints or {}
+        result = {'changed': 0, 'unchanged': 0, 'removed': 0}
+        for adom_name, adom_fws in fws.items():
+            path = self._path(adom_name)
+            fingerprint = fingerprints.get(adom_name)
+            self._written.add(os.path.basename(path))
+            if fingerprint is not None and self._fingerprints.get(path) == fingerprint and os.path.exists(path):
+                result['unchanged'] += 1
+                continue
+            try:
+                content = yaml.safe_dump([fw.as_prometheus_file_sd_entry() for fw in adom_fws]).encode('utf-8')
+            except yaml.YAMLError as err:
+                log.error(f"Failed to create file sd for {adom_name} - err: {err}")
+                continue
+            if self._write_if_changed(path, content):
+                result['changed'] += 1
+            else:
+                result['unchanged'] += 1
+            if fingerprint is not None:
+                self._fingerprints[path] = fingerprint
+
+        result['removed'] = self._remove_unknown(adom_names)
+        self._write_manifest()
+        log.info_fmt({'operation': 'file_sd', **result})
+        return result
+
+    def _path(self, adom_name: str) -> str:
+        return os.path.join(self.directory, f"{adom_name}{FILE_SD_SUFFIX}")
+
+    def _write_if_changed(self, path: str, content: bytes) -> bool:
+        content_hash = hashlib.sha256(content).hexdigest()
+        current_hash = self._hashes.get(path)
+        if current_hash is None:
+            current_hash = FileServiceDiscoveryWriter._file_hash(path)
+        if current_hash == content_hash:
+            self._hashes[path] = content_hash
+            return False
+
+        # The temporary file do not end with the suffix so Prometheus will not pick it up
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=f".{os.path.basename(path)}.", suffix='.tmp')
+        try:
+            # mkstemp create the file only readable by the owner, use the same mode as a file created by open()
+            os.chmod(tmp_path, 0o666 & ~FileServiceDiscoveryWriter._umask())
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(content)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._hashes[path] = content_hash
+        return True
+
+    @staticmethod
+    def _umask() -> int:
+        umask = os.umask(0)
+        os.umask(umask)
+        return umask
+
+    @staticmethod
+    def _file_hash(path: str) -> str:
+        try:
+            with open(path, 'rb') as existing_file:
+                return hashlib.sha256(existing_file.read()).hexdigest()
+        except OSError:
+            return ''
+
+    def remove_all(self, adom_names: List[str]) -> int:
+        """
+        Remove all files written by the writer, and the files of the adoms also if written before the manifest
+        :param adom_names: all configured adoms
+        :return: the number of removed files
+        """
+        self._written.update(f"{adom_name}{FILE_SD_SUFFIX}" for adom_name in adom_names)
+        removed = self._remove_unknown([])
+        self._write_manifest()
+        return removed
+
+    def _read_manifest(self) -> Set[str]:
+        try:
+            with open(os.path.join(self.directory, MANIFEST_FILE), 'r') as manifest_file:
+                return set(yaml.safe_load(manifest_file) or [])
+        except (OSError, yaml.YAMLError):
+            return set()
+
+    def _write_manifest(self):
+        self._write_if_changed(os.path.join(self.directory, MANIFEST_FILE),
+                               yaml.safe_dump(sorted(self._written)).encode('utf-8'))
+
+    def _remove_unknown(self, adom_names: List[str]) -> int:
+        known = {f"{adom_name}{FILE_SD_SUFFIX}" for adom_name in adom_names}
+        removed = 0
+        for file_name in sorted(self._written - known):
+            self._written.discard(file_name)
+            path = os.path.join(self.directory, file_name)
+            self._hashes.pop(path, None)
+            self._fingerprints.pop(path, None)
+            if not os.path.exists(path):
+                continue
+            os.remove(path)
+            log.info_fmt({'operation': 'file_sd', 'file': path, 'removed': True})
+            removed += 1
+        return removed
+
+
+class ShardedFileServiceDiscoveryWriter:
+    """
+    Write the Prometheus file service discovery files partitioned in shards, with the same partitioning as the
+    Prometheus hashmod relabel action. Each shard is written to its own directory, shard-<shard>, with one file
+    per adom. The unsharded files in the directory are removed, so Prometheus do not scrape the targets twice.
+    """
+
+    def __init__(self, directory: str, shards: int, shard_by: str = SHARD_BY_NAME):
+        self.shards = shards
+        self.shard_by = shard_by
+        # The writer of the unsharded files, only used to remove them
+        self.unsharded = FileServiceDiscoveryWriter(directory)
+        self.writers: List[FileServiceDiscoveryWriter] = []
+        for shard in range(shards):
+            shard_directory = os.path.join(directory, f"shard-{shard}")
+            os.makedirs(shard_directory, exist_ok=True)
+            self.writers.append(FileServiceDiscoveryWriter(shard_directory))
+
+    def write(self, fws: Dict[str, List[Fortigate]], adom_names: List[str],
+              fingerprints: Dict[str, str] = None) -> Dict[str, int]:
+        """
+        Write the files of all shards, see FileServiceDiscoveryWriter.write
+        :return: the total number of changed, unchanged and removed files
+        """
+        shard_fws: List[Dict[str, List[Fortigate]]] = [{} for _ in range(self.shards)]
+        for adom_name, adom_fws in fws.items():
+            partitions = partition(adom_fws, shard_hashes(adom_fws, self.shard_by), self.shards)
+            for shard, partition_fws in enumerate(partitions):
+                shard_fws[shard][adom_name] = partition_fws
+
+        result = {'changed': 0, 'unchanged': 0, 'removed': self.unsharded.remove_all(adom_names)}
+        for writer, writer_fws in zip(self.writers, shard_fws):
+            for key, value in writer.write(writer_fws, adom_names, fingerprints).items():
+                result[key] += value
+        return result
+
+
+class FileServiceDiscoveryWatcher:
+    """
+    Run file service discovery as a daemon with a long-lived FortiManager client. The files are refreshed every
+    interval with a random jitter, and with an exponential backoff when refresh fails.
+    SIGTERM and SIGINT stop the daemon and SIGHUP trigger an immediate refresh.
+    """
+
+    def __init__(self, config: Dict[str, Any],
+                 writer: Union[FileServiceDiscoveryWriter, ShardedFileServiceDiscoveryWriter]):
+        self.config = config
+        self.writer = writer
+        self.interval: int = int(os.getenv(FMG_DISCOVERY_WATCH_INTERVAL, "60"))
+        self.jitter: float = float(os.getenv(FMG_DISCOVERY_WATCH_JITTER, "0.1"))
+        self.max_backoff: int = max(self.interval, int(os.getenv(FMG_DISCOVERY_WATCH_MAX_BACKOFF, "600")))
+        self._stop: Optional[asyncio.Event] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, self._stop.set)
+        loop.add_signal_handler(signal.SIGINT, self._stop.set)
+        loop.add_signal_handler(signal.SIGHUP, self._wakeup.set)
+
+        failures = 0
+        async with FederatedFMG(self.config) as fmg:
+            while not self._stop.is_set():
+                self._wakeup.clear()
+                try:
+                    await _discover(fmg, self.config, self.writer)
+                    failures = 0
+                except FmgException as err:
+                    failures += 1
+                    log.error(f"File service discovery failed - err: {err.message}")
+                except Exception as err:
+                    failures += 1
+                    log.error(f"File service discovery failed - err: {str(err)}")
+                await self._sleep(self.next_delay(failures))
+        log.info_fmt({'operation': 'file_sd', MESSAGE: 'Stopped'})
+
+    def next_delay(self, failures: int) -> float:
+        """
+        The number of seconds to the next refresh
+        :param failures: the number of consecutive failed refreshes
+        :return:
+        """
+        delay = min(self.max_backoff, self.interval * 2 ** failures)
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    async def _sleep(self, delay: float):
+        # Wait for the delay, or until stopped or woken up by SIGHUP
+        waiters = [asyncio.ensure_future(self._stop.wait()), asyncio.ensure_future(self._wakeup.wait())]
+        _, pending = await asyncio.wait(waiters, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in pending:
+            waiter.cancel()
+
+
+async def _discover(fmg: FederatedFMG, config: Dict[str, Any],
+                    writer: Union[FileServiceDiscoveryWriter, ShardedFileServiceDiscoveryWriter]) -> Dict[str, int]:
+    """
+    Get the Fortigates from the FortiManagers and write the file sd files, one file per adom key
+    :raise FmgException: if no adom could be fetched
+    """
+    adom_names = [adom_key(adom) for adom in configured_adoms(config)]
+    fws = await fmg.get_fmg_devices()
+    if adom_names and not fws:
+        raise FmgException(message="No adoms could be fetched from FortiManager")
+
+    return writer.write(fws, adom_names, fmg.fingerprints)
+
+
+async def _discover_once(config: Dict[str, Any],
+                         writer: Union[FileServiceDiscoveryWriter, ShardedFileServiceDiscoveryWriter]) \
+        -> Dict[str, int]:
+    async with FederatedFMG(config) as fmg:
+        return await _discover(fmg, config, writer)
+
+
+def file_service_discovery(watch: bool = False):
     # Run for as file service discovery
     if not os.getenv(FMG_DISCOVERY_PROMETHEUS_SD_FILE_DIRECTORY):
         print(f"Env FMG_PROMETHEUS_SD_FILE_DIRECTORY must be set to a existing directory path")
@@ -47,21 +313,18 @@ def file_service_discovery():
         except yaml.YAMLError as err:
             print(err)
 
-    fmg = FMG(config)
-    fws = fmg.get_fmg_devices()
+    shards = int(os.getenv(FMG_DISCOVERY_SHARDS, "1"))
+    if shards > 1:
+        writer = ShardedFileServiceDiscoveryWriter(os.getenv(FMG_DISCOVERY_PROMETHEUS_SD_FILE_DIRECTORY), shards,
+                                                   os.getenv(FMG_DISCOVERY_SHARD_BY, SHARD_BY_NAME))
+    else:
+        writer = FileServiceDiscoveryWriter(os.getenv(FMG_DISCOVERY_PROMETHEUS_SD_FILE_DIRECTORY))
+    if watch:
+        asyncio.run(FileServiceDiscoveryWatcher(config, writer).run())
+        return
 
-    prometheus_file_sd: Dict[str, List[Any]] = {}
-    for adom_name, fws in fws.items():
-        for fw in fws:
-
-            if adom_name not in prometheus_file_sd:
-                prometheus_file_sd[adom_name] = []
-            prometheus_file_sd[adom_name].append(fw.as_prometheus_file_sd_entry())
-
-        # Generate configuration
-        with open(f"{os.getenv(FMG_DISCOVERY_PROMETHEUS_SD_FILE_DIRECTORY)}/{adom_name}.yaml", 'w') as config_file:
-            try:
-                if adom_name in prometheus_file_sd:
-                    yaml.safe_dump(prometheus_file_sd[adom_name], config_file)
-            except yaml.YAMLError as err:
-                print(err)
+    try:
+        asyncio.run(_discover_once(config, writer))
+    except FmgException as err:
+        log.error(err.message)
+        exit(1)
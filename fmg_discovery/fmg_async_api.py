@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2023  Anders Håål
+
+    This file is part of fortigate-exporter-discovery.
+
+    fortigate-exporter-discovery is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    fortigate-exporter-discovery is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fortigate-exporter-discovery.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import asyncio
+import hashlib
+import logging
+import time
+from typing import List, Dict, Any, Optional, AsyncIterator, Iterable, Iterator, Tuple
+
+import aiohttp
+from prometheus_client import Counter, Histogram
+
+from fmg_discovery import json_codec
+from fmg_discovery.exceptions import FmgException
+from fmg_discovery.fw import Fortigate, fw_factory, adom_labels
+from fmg_discovery.fmglogging import Log, MESSAGE
+
+log = Log(__name__)
+
+# Default max number of concurrent json-rpc requests against the FortiManager
+DEFAULT_CONCURRENCY = 10
+# Default timeout in seconds for a single json-rpc request
+DEFAULT_TIMEOUT = 10
+# Default max number of pooled keep-alive connections to the FortiManager
+DEFAULT_POOL_SIZE = 10
+# Default time in seconds an idle keep-alive connection is kept in the pool
+DEFAULT_KEEPALIVE_TIMEOUT = 30
+# Default number of adoms fetched in a single json-rpc request
+DEFAULT_BATCH_SIZE = 1
+# Default number of devices fetched per page, 0 means no paging
+DEFAULT_PAGE_SIZE = 0
+# Json-rpc status code returned by FortiManager when the session is not valid anymore
+STATUS_NO_PERMISSION = -11
+
+# The json-rpc urls, also used as the url label of the metrics
+LOGIN_URL = "/sys/login/user"
+LOGOUT_URL = "/sys/logout"
+ADOMS_URL = "/dvmdb/adom"
+DEVICES_URL = "/dvmdb/adom/{adom}/device"
+# The adom label of requests for multiple adoms
+ADOM_MULTIPLE = '*'
+
+RPC_DURATION = Histogram('fmg_discovery_fmg_rpc_duration_seconds', 'Duration of json-rpc requests to FortiManager',
+                         ['fmg', 'method', 'url', 'adom'])
+RPC_RESPONSE_BYTES = Counter('fmg_discovery_fmg_rpc_response_bytes', 'Size of json-rpc responses from FortiManager',
+                             ['fmg', 'method', 'url'])
+DEVICES_FETCHED = Counter('fmg_discovery_fmg_devices_fetched', 'Number of devices fetched from FortiManager',
+                          ['fmg', 'adom'])
+LOGINS = Counter('fmg_discovery_fmg_logins', 'Number of logins to FortiManager', ['fmg'])
+LOGIN_FAILURES = Counter('fmg_discovery_fmg_login_failures', 'Number of failed logins to FortiManager', ['fmg'])
+
+# Data fields to collect from fmg
+DEVICE_FIELDS = ["name", "hostname", "alias", "ip", "sn", "hostname", "latitude", "longitude", "tunnel_ip", "os_ver",
+                 "mr", "build", "patch", "ha_mode", "ha_slave", "ha_group_id", "ha_group_name", "hw_rev_major",
+                 "conf_status", "conn_status", "conn_mode", "desc", "mgmt_if", "mgmt_mode", "platform_str"]
+
+
+class AsyncFMG:
+    """
+    A asyncio based FortiManager client. All adoms are fetched concurrently, limited by the configured
+    concurrency, so a slow FortiManager never blocks the event loop.
+    The client is meant to be long-lived. The http connections are pooled and kept alive and the FortiManager
+    session is reused until it expire, and then a new login is done transparently.
+    """
+
+    def __init__(self, config, name: Optional[str] = None):
+        """
+        Init
+        :param config: a dict {'fmg': {'host': 'https://localhost:3443', 'username': 'abc', 'password': 'XYZ',
+        'concurrency': 10, 'timeout': 10, 'pool_size': 10, 'keepalive_timeout': 30,
+        'batch_size': 1, 'page_size': 0, 'adoms': [{'name': 'SDWAN_Adoms', ...}]}}
+        :param name: the name of the FortiManager used in metrics, default the host
+        """
+        fmg_config = config.get('fmg')
+        self.credentials = {'host': fmg_config.get('host'), 'username': fmg_config.get('username'),
+                            'password': fmg_config.get('password')}
+        self.name: str = name or self.credentials['host']
+        self.fmg_configuration = config
+        self.request_url = self.credentials['host'] + "/jsonrpc"
+        self.session = None
+        self.concurrency: int = int(fmg_config.get('concurrency', DEFAULT_CONCURRENCY))
+        self.timeout: int = int(fmg_config.get('timeout', DEFAULT_TIMEOUT))
+        self.pool_size: int = int(fmg_config.get('pool_size', DEFAULT_POOL_SIZE))
+        self.keepalive_timeout: int = int(fmg_config.get('keepalive_timeout', DEFAULT_KEEPALIVE_TIMEOUT))
+        self.batch_size: int = max(1, int(fmg_config.get('batch_size', DEFAULT_BATCH_SIZE)))
+        self.page_size: int = max(0, int(fmg_config.get('page_size', DEFAULT_PAGE_SIZE)))
+        self._client: Optional[aiohttp.ClientSession] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._login_lock: Optional[asyncio.Lock] = None
+        # The fingerprint of the last fetched devices per adom
+        self.fingerprints: Dict[str, str] = {}
+        # The fingerprint, Fortigates and number of devices of each page, and all Fortigates, of the last fetch
+        # per adom
+        self._pages: Dict[str, List[Tuple[str, List[Fortigate], int]]] = {}
+        self._fws: Dict[str, List[Fortigate]] = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        """
+        Logout from the FortiManager and close the underlying http client
+        :return:
+        """
+        await self._fmg_logout()
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    def _get_client(self) -> aiohttp.ClientSession:
+        # The client must be created from within a running event loop
+        if self._client is None:
+            connector = aiohttp.TCPConnector(ssl=False, limit=self.pool_size,
+                                             keepalive_timeout=self.keepalive_timeout)
+            self._client = aiohttp.ClientSession(headers={'content-type': 'application/json'},
+                                                 timeout=aiohttp.ClientTimeout(total=self.timeout),
+                                                 connector=connector)
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._login_lock = asyncio.Lock()
+        return self._client
+
+    async def _post(self, datagram: Dict[str, Any], url: str, adom: str = '') -> Dict[str, Any]:
+        """
+        Post the json-rpc datagram
+        :param datagram:
+        :param url: the url label of the metrics
+        :param adom: the adom label of the metrics
+        :return: the json-rpc response
+        """
+        client = self._get_client()
+        async with self._semaphore:
+            start = time.perf_counter()
+            async with client.post(self.request_url, data=json_codec.dumps(datagram)) as response_raw:
+                body = await response_raw.read()
+            RPC_DURATION.labels(self.name, datagram['method'], url, adom).observe(time.perf_counter() - start)
+        RPC_RESPONSE_BYTES.labels(self.name, datagram['method'], url).inc(len(body))
+        return json_codec.loads(body)
+
+    async def _call(self, datagram: Dict[str, Any], url: str, adom: str = '') -> Dict[str, Any]:
+        """
+        Do a json-rpc call with the current session. If the session has expired a new login is done and the call
+        is done again.
+        :param datagram: the json-rpc datagram without session
+        :param url: the url label of the metrics
+        :param adom: the adom label of the metrics
+        :return: the json-rpc response
+        """
+        session = self.session
+        response_data = await self._post({**datagram, "session": session}, url, adom)
+        if AsyncFMG._session_expired(response_data):
+            log.info_fmt({'operation': 'fmg_login', MESSAGE: 'Session expired'})
+            await self._ensure_session(expired=session)
+            response_data = await self._post({**datagram, "session": self.session}, url, adom)
+        return response_data
+
+    @staticmethod
+    def _session_expired(response_data: Dict[str, Any]) -> bool:
+        try:
+            for result in response_data["result"]:
+                status = result["status"]
+                if status["code"] == STATUS_NO_PERMISSION or 'no permission' in str(status.get("message")).lower():
+                    return True
+        except (KeyError, TypeError, AttributeError):
+            pass
+        return False
+
+    async def _ensure_session(self, expired: Optional[str] = None):
+        """
+        Login if there is no session or if the current session is the expired one. Concurrent callers
+        will share the same login.
+        :param expired: the session that was found expired
+        :return:
+        """
+        self._get_client()
+        async with self._login_lock:
+            if self.session is None or self.session == expired:
+                await self._fmg_login()
+
+    async def _fmg_login(self):
+        """
+        Login at create a session
+        :return:
+        """
+
+        datagram = {"id": 1, "method": "exec", "params": [
+            {"data": {"passwd": self.credentials["password"], "user": self.credentials["username"]},
+             "url": LOGIN_URL}]}
+        LOGINS.labels(self.name).inc()
+        try:
+            self.session = None
+            response_login = await self._post(datagram, LOGIN_URL)
+            assert response_login['id'] == datagram['id']
+            self.session = response_login["session"]
+        except aiohttp.ClientConnectionError as err:
+            LOGIN_FAILURES.labels(self.name).inc()
+            log.error(f"Connection error on login: {err}")
+        except Exception as err:
+            LOGIN_FAILURES.labels(self.name).inc()
+            log.error(f"Error on login: {err}")
+
+    async def _fmg_logout(self):
+        """
+        Logout the current session
+        :return:
+        """
+        if self.session is None or self._client is None:
+            return
+
+        datagram = {"id": 1, "method": "exec", "params": [{"url": LOGOUT_URL}], "session": self.session}
+        try:
+            await self._post(datagram, LOGOUT_URL)
+        except Exception as err:
+            log.error(f"Error on logout: {err}")
+        self.session = None
+
+    def clear_fingerprints(self):
+        """
+        Forget the fingerprints and Fortigates of the last fetch, so all Fortigates are created again on the next
+        fetch
+        :return:
+        """
+        self.fingerprints.clear()
+        self._pages.clear()
+        self._fws.clear()
+
+    async def get_fmg_devices(self, adoms: List[Dict[str, Any]] = None) -> Dict[str, List[Fortigate]]:
+        """
+        Get FW data from FMG, all adoms are fetched concurrently in batches of batch_size adoms per request.
+        If page_size is set the devices are fetched page by page and each page is turned into Fortigate objects
+        before the next page is requested.
+        Each page is fingerprinted, and if a page is the same as in the last fetch its Fortigates are reused. If all
+        pages of an adom are unchanged the same list as in the last fetch is returned, and the fingerprint of the
+        adom is unchanged.
+        Adoms that failed are not part of the result.
+        :param adoms: the adom configurations to fetch, default all configured adoms
+        """
+
+        await self._ensure_session()
+        if self.session is None:
+            raise FmgException(message="No session - login to FortiManager failed")
+        if adoms is None:
+            adoms = self.fmg_configuration['fmg']['adoms']
+        if not adoms:
+            log.warn(f"ADOM is not configured. No data received from FortiManager.")
+            return {}
+
+        all_adom_devices: Dict[str, List[Fortigate]] = {}
+
+        async def fetch_batch(batch: List[Dict[str, Any]]):
+            first_pages = await self._get_fw_devices_batch([adom['name'] for adom in batch])
+            for adom in batch:
+                first_page = first_pages.pop(adom['name'])
+                if first_page is None:
+                    continue
+                try:
+                    all_adom_devices[adom['name']] = await self._fetch_adom(adom, first_page)
+                except FmgException as err:
+                    log.error(err.message)
+
+        await asyncio.gather(*[fetch_batch(adoms[i:i + self.batch_size])
+                               for i in range(0, len(adoms), self.batch_size)])
+
+        # Keep the configured order
+        return {adom['name']: all_adom_devices[adom['name']] for adom in adoms if adom['name'] in all_adom_devices}
+
+    async def _fetch_adom(self, adom: Dict[str, Any], first_page: List[Dict[str, Any]]) -> List[Fortigate]:
+        adom_name = adom['name']
+        previous_pages = self._pages.get(adom_name, [])
+        pages: List[Tuple[str, List[Fortigate], int]] = []
+        # The adom configuration is part of the fingerprint since it is used to create the Fortigates
+        config_fingerprint = fingerprint(adom)
+        async for page in self._iter_fw_device_pages(adom_name, first_page):
+            page_fingerprint = fingerprint([config_fingerprint, page])
+            index = len(pages)
+            if index < len(previous_pages) and previous_pages[index][0] == page_fingerprint:
+                pages.append(previous_pages[index])
+            else:
+                pages.append((page_fingerprint, list(AsyncFMG._as_fortigates(adom, page)), len(page)))
+        return self._set_pages(adom_name, config_fingerprint, pages)
+
+    def _set_pages(self, adom_name: str, config_fingerprint: str, pages: List[Tuple[str, List[Fortigate], int]]) \
+            -> List[Fortigate]:
+        """
+        Keep the fetched pages of an adom until the next fetch
+        :return: the Fortigates of the adom, the same list as in the last fetch if no page has changed
+        """
+        adom_fingerprint = hashlib.sha1(config_fingerprint.encode('utf-8'))
+        for page_fingerprint, _, _ in pages:
+            adom_fingerprint.update(page_fingerprint.encode('utf-8'))
+
+        self._pages[adom_name] = pages
+        if self.fingerprints.get(adom_name) != adom_fingerprint.hexdigest() or adom_name not in self._fws:
+            self._fws[adom_name] = [fw for _, page_fws, _ in pages for fw in page_fws]
+            self.fingerprints[adom_name] = adom_fingerprint.hexdigest()
+        elif log.is_enabled(logging.DEBUG):
+            log.debug_fmt({'operation': 'fingerprint', 'adom': adom_name, 'changed': 'false'})
+        return self._fws[adom_name]
+
+    @staticmethod
+    def _as_fortigates(adom: Dict[str, Any], devices: Iterable[Dict[str, Any]]) -> Iterator[Fortigate]:
+        labels = adom_labels(adom)
+        for device in devices:
+            fw = AsyncFMG._as_fortigate(adom, device, labels)
+            if fw is not None:
+                yield fw
+
+    @staticmethod
+    def _as_fortigate(adom: Dict[str, Any], device: Dict[str, Any], labels: Dict[str, str]) -> Optional[Fortigate]:
+        fw = fw_factory(adom, device, labels)
+        valid, cause = fw.valid()
+        if not valid:
+            if log.is_enabled(logging.WARNING):
+                log.warn_fmt({'operation': 'fw_validate', 'adom': adom['name'], 'fw': fw.name, "status": 'false',
+                              "cause": cause})
+            return None
+        return fw
+
+    async def _iter_fw_device_pages(self, adom: str, first_page: List[Dict[str, Any]]) \
+            -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        Iterate the device pages of an adom. A page shorter than page_size is the last page.
+        :param adom: the adom name
+        :param first_page: the already fetched first page
+        :return:
+        :raise FmgException: if a page could not be fetched
+        """
+        page = first_page
+        offset = 0
+        while True:
+            yield page
+            if not self.page_size or len(page) < self.page_size:
+                return
+            offset += len(page)
+            page = (await self._get_fw_devices_batch([adom], offset=offset))[adom]
+            if page is None:
+                raise FmgException(message=f"{adom} - failed to get devices from offset {offset}")
+
+    async def _get_fw_devices_batch(self, adoms: List[str], offset: int = 0) \
+            -> Dict[str, Optional[List[Dict[str, Any]]]]:
+        """
+        Get the devices for multiple adoms in a single json-rpc request. Each adom is a separate entry in params
+        and the result entry with the same index is mapped back to the adom. A failing adom is logged and returns
+        None without affecting the other adoms in the batch.
+        If page_size is set only the page starting at offset is returned for each adom.
+        :param adoms: the adom names
+        :param offset: the device offset when paging
+        :return: a dict of adom name and its devices
+        """
+        params = [self._devices_param(adom, offset) for adom in adoms]
+        datagram = {"id": 1, "method": "get", "params": params, "verbose": 1}
+        devices: Dict[str, Optional[List[Dict[str, Any]]]] = {adom: None for adom in adoms}
+        try:
+            response_data = await self._call(datagram, DEVICES_URL, adoms[0] if len(adoms) == 1 else ADOM_MULTIPLE)
+            for adom, result in zip(adoms, response_data["result"]):
+                try:
+                    if result["status"]["code"] != 0:
+                        log.error(f"Data from API {str(result['url'])} "
+                                  f"returned code: {str(result['status']['code'])} "
+                                  f"with message: {str(result['status']['message'])}")
+                    else:
+                        devices[adom] = result.get("data") or []
+                        DEVICES_FETCHED.labels(self.name, adom).inc(len(devices[adom]))
+                        log.info(f"{adom} - found {len(devices[adom])} firewalls.")
+                except Exception as err:
+                    log.error(f"Error on data retrieval for adom {adom}: {err}")
+        except aiohttp.ClientConnectionError as err:
+            log.error(f"Connection Error on data retrieval: {err}")
+        except Exception as err:
+            log.error(f"Error on data retrieval: {err}")
+        return devices
+
+    def _devices_param(self, adom: str, offset: int = 0) -> Dict[str, Any]:
+        param = {"url": DEVICES_URL.format(adom=adom), "fields": DEVICE_FIELDS}
+        if self.page_size:
+            param["range"] = [offset, self.page_size]
+        return param
+
+
+def fingerprint(data: Any) -> str:
+    """
+    A stable hash of json serializable data
+    :param data:
+    :return:
+    """
+    return hashlib.sha1(json_codec.dumps_sorted(data)).hexdigest()
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2023  Anders Håål
+
+    This file is part of fortigate-exporter-discovery.
+
+    fortigate-exporter-discovery is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    fortigate-exporter-discovery is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fortigate-exporter-discovery.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import asyncio
+import time
+from typing import List, Dict, Any, Optional
+from urllib.parse import urlparse
+
+from prometheus_client import Counter, Histogram
+
+from fmg_discovery.exceptions import FmgException
+from fmg_discovery.fmg_async_api import AsyncFMG
+from fmg_discovery.fmglogging import Log
+from fmg_discovery.fw import Fortigate
+
+log = Log(__name__)
+
+FMG_FETCH_DURATION = Histogram('fmg_discovery_fmg_fetch_duration_seconds',
+                               'Duration of fetching the devices of the adoms from a FortiManager', ['fmg'])
+FMG_FETCH_FAILURES = Counter('fmg_discovery_fmg_fetch_failures',
+                             'Number of fetches where no adom could be fetched from a FortiManager', ['fmg'])
+
+
+def fmg_configs(config: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Get the FortiManager configurations, fmg can be a single FortiManager or a list of FortiManagers
+    :param config:
+    :return:
+    """
+    fmg_config = config.get('fmg')
+    if not fmg_config:
+        return []
+    if isinstance(fmg_config, list):
+        return fmg_config
+    return [fmg_config]
+
+
+def fmg_name(fmg_config: Dict[str, Any]) -> str:
+    """
+    The name of the FortiManager, default the host name of the FortiManager url
+    :param fmg_config:
+    :return:
+    """
+    if fmg_config.get('name'):
+        return str(fmg_config['name'])
+    host = fmg_config.get('host') or ''
+    return urlparse(host).hostname or host
+
+
+def configured_adoms(config: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Get the adom configurations of all FortiManagers. Each adom configuration get the name of its FortiManager as
+    fmg. If fmg is a list of FortiManagers the adom is identified by the key <fmg name>.<adom name>, since the same
+    adom name can exist in multiple FortiManagers.
+    :param config:
+    :return:
+    """
+    federated = isinstance(config.get('fmg'), list)
+    adoms = []
+    for fmg_config in fmg_configs(config):
+        name = fmg_name(fmg_config)
+        for adom in fmg_config.get('adoms') or []:
+            if federated:
+                adoms.append({**adom, 'fmg': name, 'key': f"{name}.{adom['name']}"})
+            else:
+                adoms.append({**adom, 'fmg': name})
+    return adoms
+
+
+def adom_key(adom: Dict[str, Any]) -> str:
+    """
+    The key that identify the adom configuration among all FortiManagers
+    :param adom: a adom configuration from configured_adoms
+    :return:
+    """
+    return adom.get('key', adom['name'])
+
+
+class FederatedFMG:
+    """
+    A client for one or more FortiManagers. Each FortiManager has its own AsyncFMG client, with its own
+    credentials, connection pool and session, and all FortiManagers are fetched concurrently. A FortiManager that
+    fail does not affect the others, its adoms are just not part of the result.
+    The result is keyed by adom key, see configured_adoms.
+    """
+
+    def __init__(self, config: Dict[str, Any]):
+        """
+        Init
+        :param config: a dict {'fmg': {'host': ...}} or {'fmg': [{'name': 'emea', 'host': ...}, ...]}
+        """
+        self.fmg_configuration = config
+        self.fmgs: Dict[str, AsyncFMG] = {}
+        for fmg_config in fmg_configs(config):
+            name = fmg_name(fmg_config)
+            if name in self.fmgs:
+                raise FmgException(message=f"FortiManager {name} is configured more than once, use name to make "
+                                           f"them unique")
+            self.fmgs[name] = AsyncFMG({'fmg': fmg_config}, name)
+        # The fingerprint of the last fetched devices per adom key
+        self.fingerprints: Dict[str, str] = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        """
+        Logout from and close all FortiManager clients
+        :return:
+        """
+        await asyncio.gather(*[fmg.close() for fmg in self.fmgs.values()])
+
+    def clear_fingerprints(self):
+        """
+        Forget the fingerprints of the last fetch of all FortiManagers, see AsyncFMG.clear_fingerprints
+        :return:
+        """
+        self.fingerprints.clear()
+        for fmg in self.fmgs.values():
+            fmg.clear_fingerprints()
+
+    def adoms(self) -> List[Dict[str, Any]]:
+        return configured_adoms(self.fmg_configuration)
+
+    async def get_fmg_devices(self, adoms: List[Dict[str, Any]] = None) -> Dict[str, List[Fortigate]]:
+        """
+        Get the Fortigates of the adoms from all FortiManagers concurrently. Adoms that failed, including all adoms
+        of a FortiManager that failed, are not part of the result.
+        :param adoms: the adom configurations from configured_adoms to fetch, default all configured adoms
+        :return: the Fortigates per adom key, in the order of adoms
+        :raise FmgException: if all FortiManagers failed
+        """
+        if adoms is None:
+            adoms = self.adoms()
+        if not adoms:
+            log.warn(f"ADOM is not configured. No data received from FortiManager.")
+            return {}
+
+        fmg_adoms: Dict[str, List[Dict[str, Any]]] = {}
+        for adom in adoms:
+            fmg_adoms.setdefault(adom['fmg'], []).append(adom)
+
+        results = await asyncio.gather(*[self._fetch(name, name_adoms) for name, name_adoms in fmg_adoms.items()])
+        if not any(result is not None for result in results):
+            raise FmgException(message=f"No FortiManager could be fetched - {', '.join(fmg_adoms)}")
+
+        all_adom_devices: Dict[str, List[Fortigate]] = {}
+        for result in results:
+            if result is not None:
+                all_adom_devices.update(result)
+        return {adom_key(adom): all_adom_devices[adom_key(adom)] for adom in adoms
+                if adom_key(adom) in all_adom_devices}
+
+    async def _fetch(self, name: str, adoms: List[Dict[str, Any]]) -> Optional[Dict[str, List[Fortigate]]]:
+        """
+        Fetch the adoms of a single FortiManager
+        :return: the Fortigates per adom key, or None if the FortiManager failed
+        """
+        fmg = self.fmgs.get(name)
+        if fmg is None:
+            log.error(f"FortiManager {name} is not configured")
+            return None
+        start = time.perf_counter()
+        try:
+            fws = await fmg.get_fmg_devices(adoms)
+        except FmgException as err:
+            FMG_FETCH_FAILURES.labels(name).inc()
+            log.error(f"FortiManager {name} - {err.message}")
+            return None
+        except Exception as err:
+            FMG_FETCH_FAILURES.labels(name).inc()
+            log.error(f"FortiManager {name} - failed to get devices - err: {str(err)}")
+            return None
+        finally:
+            FMG_FETCH_DURATION.labels(name).observe(time.perf_counter() - start)
+        if not fws:
+            FMG_FETCH_FAILURES.labels(name).inc()
+            log.error(f"FortiManager {name} - no adoms could be fetched")
+            return None
+        log.info_fmt({'operation': 'fmg_fetch', 'fmg': name, 'adoms': len(fws),
+                      'response_time': round(time.perf_counter() - start, 3)})
+
+        result: Dict[str, List[Fortigate]] = {}
+        for adom in adoms:
+            if adom['name'] in fws:
+                result[adom_key(adom)] = fws[adom['name']]
+                if adom['name'] in fmg.fingerprints:
+                    self.fingerprints[adom_key(adom)] = fmg.fingerprints[adom['name']]
+        return result
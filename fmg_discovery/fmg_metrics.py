@@ -19,7 +19,8 @@
 
 """
 
-from typing import Dict, List
+from array import array
+from typing import Dict, List, Iterable, Iterator
 
 from prometheus_client.core import GaugeMetricFamily
 from prometheus_client.metrics_core import Metric
@@ -34,6 +35,11 @@ SYSTEM_INFO_USAGE = 'system_info_usage'
 SYSTEM_INFO = 'system_info'
 VPN_TUNNELS = 'vpn_tunnels'
 
+# The status metrics and the status value that map to 1
+STATUS_METRICS = {'conf_status': 'insync', 'conn_status': 'up', 'conn_mode': 'active'}
+# The exposition format of the status values, same as floatToGoString
+STATUS_VALUES = {1.0: '1.0', 0.0: '0.0'}
+
 log = Log(__name__)
 
 
@@ -117,3 +123,78 @@ class FmgMetrics(Transform):
         if status == valid:
             return 1.0
         return 0.0
+
+
+class FmgMetricColumns:
+    """
+    The fmg metrics of the Fortigates in an adom stored as columns. The status values are stored as arrays and the
+    escaped label string of each Fortigate is created once, so the text exposition of a metric is rendered in a
+    single pass without creating any samples.
+    The output is the same as generate_latest of the metrics created by FmgMetrics.
+    """
+    label_keys = sorted(FmgMetricDefinition.Labels().get_label_keys())
+
+    def __init__(self, fws: List[Fortigate]):
+        self.labels: List[str] = []
+        self.columns: Dict[str, array] = {metric: array('d') for metric in STATUS_METRICS}
+        self._samples: Dict[str, bytes] = {}
+        for f in fws:
+            label_values = {'ip': f.ip, 'name': f.name, 'adom': f.adom, 'platform': f.platform}
+            self.labels.append('{' + ','.join(f'{key}="{escape_label_value(label_values[key])}"'
+                                              for key in FmgMetricColumns.label_keys) + '}')
+            for metric, valid in STATUS_METRICS.items():
+                self.columns[metric].append(FmgMetrics.status_mapping(getattr(f, metric), valid))
+
+    def samples(self, metric: str) -> bytes:
+        """
+        The text exposition of all samples of the metric, only rendered the first time
+        :param metric: the metric, a key in STATUS_METRICS
+        :return:
+        """
+        if metric not in self._samples:
+            name = f"{FmgMetricDefinition.prefix}{metric}"
+            self._samples[metric] = ''.join([f"{name}{labels} {STATUS_VALUES[value]}\n"
+                                             for labels, value in zip(self.labels, self.columns[metric])]
+                                            ).encode('utf-8')
+        return self._samples[metric]
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+_headers: Dict[str, bytes] = {}
+
+
+def _exposition_headers() -> Dict[str, bytes]:
+    # The HELP and TYPE lines of each status metric
+    if not _headers:
+        for metric, definition in FmgMetricDefinition.metrics_definition().items():
+            documentation = definition.documentation.replace('\\', r'\\').replace('\n', r'\n')
+            _headers[metric] = (f"# HELP {definition.name} {documentation}\n"
+                                f"# TYPE {definition.name} {definition.type}\n").encode('utf-8')
+    return _headers
+
+
+def iter_metrics(columns: Iterable[FmgMetricColumns]) -> Iterator[bytes]:
+    """
+    Render the text exposition of the metrics of all adoms, one chunk per metric header and adom
+    :param columns: the metric columns of each adom
+    :return:
+    """
+    columns = list(columns)
+    for metric, header in _exposition_headers().items():
+        yield header
+        for c in columns:
+            samples = c.samples(metric)
+            if samples:
+                yield samples
+
+
+def generate_metrics(columns: Iterable[FmgMetricColumns]) -> bytes:
+    """
+    Render the text exposition of the metrics of all adoms
+    :param columns: the metric columns of each adom
+    :return:
+    """
+    return b''.join(iter_metrics(columns))
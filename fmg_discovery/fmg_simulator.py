@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2023  Anders Håål
+
+    This file is part of fortigate-exporter-discovery.
+
+    fortigate-exporter-discovery is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    fortigate-exporter-discovery is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fortigate-exporter-discovery.  If not, see <http://www.gnu.org/licenses/>.
+
+    A FortiManager json-rpc simulator for load and end to end testing, without a real FortiManager.
+
+    python -m fmg_discovery.fmg_simulator --adoms 10 --devices 10000 --latency 0.05 --session-ttl 300
+
+    The simulator implement /sys/login/user, /sys/logout, /dvmdb/adom and /dvmdb/adom/<adom>/device, including
+    multiple params in a request and the range option. The number of calls per method and url is returned by
+    GET /stats.
+"""
+import argparse
+import asyncio
+import random
+import secrets
+import time
+from collections import Counter
+from typing import Dict, List, Any, Optional
+
+import yaml
+from aiohttp import web
+
+from fmg_discovery import json_codec
+from fmg_discovery.fmg_async_api import LOGIN_URL, LOGOUT_URL, ADOMS_URL, STATUS_NO_PERMISSION
+
+PLATFORMS = ['FortiGate-60F', 'FortiGate-100F', 'FortiGate-VM64', 'FortiWiFi-40F', 'FortiGate-1800F']
+DEVICES_URL_PREFIX = ADOMS_URL + '/'
+DEVICES_URL_SUFFIX = '/device'
+# Json-rpc status code when the adom or url do not exist
+STATUS_NOT_EXIST = -3
+
+
+def device_row(index: int, rnd: random.Random) -> Dict[str, Any]:
+    """
+    A synthetic device row as returned by FortiManager /dvmdb/adom/<adom>/device
+    :param index:
+    :param rnd:
+    :return:
+    """
+    return {'name': f"fw-{index:06d}", 'hostname': f"fw-{index:06d}", 'alias': '',
+            'ip': f"10.{(index >> 16) & 255}.{(index >> 8) & 255}.{(index & 255) or 1}",
+            'sn': f"FGT60F{index:010d}", 'latitude': f"{rnd.uniform(-90, 90):.6f}",
+            'longitude': f"{rnd.uniform(-180, 180):.6f}", 'tunnel_ip': '', 'os_ver': 7, 'mr': 2, 'build': 1517,
+            'patch': 5, 'ha_mode': rnd.choice(['standalone', 'a-p']), 'ha_slave': None, 'ha_group_id': 0,
+            'ha_group_name': '', 'hw_rev_major': 0,
+            'conf_status': rnd.choice(['insync', 'insync', 'insync', 'outofsync']),
+            'conn_status': rnd.choice(['up', 'up', 'up', 'down']),
+            'conn_mode': rnd.choice(['active', 'active', 'passive']),
+            'desc': 'Synthetic "test" device', 'mgmt_if': 'port1', 'mgmt_mode': 'fmg',
+            'platform_str': rnd.choice(PLATFORMS)}
+
+
+def device_rows(devices: int, adoms: int = 10, seed: int = 42) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Create synthetic device rows spread over a number of adoms
+    :param devices: total number of devices
+    :param adoms: number of adoms
+    :param seed: random seed so the rows are the same in every run
+    :return: the device rows per adom name
+    """
+    rnd = random.Random(seed)
+    rows: Dict[str, List[Dict[str, Any]]] = {f"ADOM_{a:03d}": [] for a in range(adoms)}
+    names = list(rows.keys())
+    for index in range(devices):
+        rows[names[index % adoms]].append(device_row(index, rnd))
+    return rows
+
+
+class FmgSimulator:
+    """
+    A simulated FortiManager json-rpc api
+    """
+
+    def __init__(self, rows: Dict[str, List[Dict[str, Any]]], latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, error_code: int = STATUS_NOT_EXIST, session_ttl: float = 0.0,
+                 seed: Optional[int] = None):
+        """
+        Init
+        :param rows: the device rows per adom
+        :param latency: the latency in seconds of each call
+        :param jitter: a random extra latency in seconds, 0 to jitter, of each call
+        :param error_rate: the fraction of device results that return error_code
+        :param error_code: the json-rpc status code of injected errors
+        :param session_ttl: the number of seconds a session is valid, 0 for no expiry
+        :param seed: the random seed of the jitter and the error injection
+        """
+        self.rows = rows
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.session_ttl = session_ttl
+        self.sessions: Dict[str, float] = {}
+        self.calls: Counter = Counter()
+        self._random = random.Random(seed)
+
+    def app(self) -> web.Application:
+        application = web.Application()
+        application.router.add_post('/jsonrpc', self.jsonrpc)
+        application.router.add_get('/stats', self.stats)
+        return application
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({'calls': {f"{method} {url}": count for (method, url), count in self.calls.items()},
+                                  'sessions': len(self.sessions)})
+
+    async def jsonrpc(self, request: web.Request) -> web.Response:
+        datagram = json_codec.loads(await request.read())
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+
+        method = datagram.get('method')
+        params = datagram.get('params') or []
+        for param in params:
+            self.calls[(method, self._url_template(param.get('url', '')))] += 1
+
+        if params and params[0].get('url') == LOGIN_URL:
+            return self._response(datagram, [self._status(0, 'OK', LOGIN_URL)], session=self._login())
+        if not self._valid_session(datagram.get('session')):
+            return self._response(datagram, [self._status(STATUS_NO_PERMISSION, 'No permission for the resource',
+                                                          param.get('url')) for param in params])
+        if params and params[0].get('url') == LOGOUT_URL:
+            self.sessions.pop(datagram.get('session'), None)
+            return self._response(datagram, [self._status(0, 'OK', LOGOUT_URL)])
+        return self._response(datagram, [self._get(param) for param in params])
+
+    def _login(self) -> str:
+        session = secrets.token_hex(16)
+        self.sessions[session] = time.time() + self.session_ttl if self.session_ttl else float('inf')
+        return session
+
+    def _valid_session(self, session: Optional[str]) -> bool:
+        expire = self.sessions.get(session)
+        if expire is None:
+            return False
+        if time.time() >= expire:
+            del self.sessions[session]
+            return False
+        return True
+
+    def _get(self, param: Dict[str, Any]) -> Dict[str, Any]:
+        url = param.get('url', '')
+        if url == ADOMS_URL:
+            return {**self._status(0, 'OK', url), 'data': [{'name': name, 'mr': '4'} for name in self.rows]}
+        adom = self._adom(url)
+        if adom is None or adom not in self.rows:
+            return self._status(STATUS_NOT_EXIST, 'Object does not exist', url)
+        if self.error_rate and self._random.random() < self.error_rate:
+            return self._status(self.error_code, 'Simulated error', url)
+        data = self.rows[adom]
+        if 'range' in param:
+            offset, limit = param['range']
+            data = data[offset:offset + limit]
+        fields = param.get('fields')
+        if fields:
+            data = [{field: row[field] for field in fields if field in row} for row in data]
+        return {**self._status(0, 'OK', url), 'data': data}
+
+    @staticmethod
+    def _adom(url: str) -> Optional[str]:
+        if url.startswith(DEVICES_URL_PREFIX) and url.endswith(DEVICES_URL_SUFFIX):
+            return url[len(DEVICES_URL_PREFIX):-len(DEVICES_URL_SUFFIX)]
+        return None
+
+    @staticmethod
+    def _url_template(url: str) -> str:
+        if FmgSimulator._adom(url) is not None:
+            return f"{DEVICES_URL_PREFIX}{{adom}}{DEVICES_URL_SUFFIX}"
+        return url
+
+    @staticmethod
+    def _status(code: int, message: str, url: Optional[str]) -> Dict[str, Any]:
+        return {'status': {'code': code, 'message': message}, 'url': url}
+
+    @staticmethod
+    def _response(datagram: Dict[str, Any], results: List[Dict[str, Any]], session: Optional[str] = None) \
+            -> web.Response:
+        response: Dict[str, Any] = {'id': datagram.get('id'), 'result': results}
+        if session is not None:
+            response['session'] = session
+        return web.Response(body=json_codec.dumps(response), content_type='application/json')
+
+
+def simulator_config(host: str, rows: Dict[str, List[Dict[str, Any]]]) -> Dict[str, Any]:
+    """
+    A fmg_discovery configuration for the simulator
+    :param host: the url of the simulator
+    :param rows:
+    :return:
+    """
+    return {'fmg': {'host': host, 'username': 'simulator', 'password': 'simulator',
+                    'adoms': [{'name': adom_name, 'labels': {'customer': adom_name.lower()},
+                               'fortigate': {'token': 'simulator-token', 'port': 44343}} for adom_name in rows]}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='FortiManager json-rpc simulator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18443)
+    parser.add_argument('--adoms', type=int, default=10, help='Number of adoms, default 10')
+    parser.add_argument('--devices', type=int, default=1000, help='Total number of devices, default 1000')
+    parser.add_argument('--latency', type=float, default=0.0, help='Latency in seconds of each call, default 0')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random extra latency in seconds, default 0')
+    parser.add_argument('--error-rate', type=float, default=0.0, dest='error_rate',
+                        help='Fraction of adom device results that fail, default 0')
+    parser.add_argument('--error-code', type=int, default=STATUS_NOT_EXIST, dest='error_code',
+                        help=f"The json-rpc status code of failed results, default {STATUS_NOT_EXIST}")
+    parser.add_argument('--session-ttl', type=float, default=0.0, dest='session_ttl',
+                        help='Seconds until a session expire, default 0 (never)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--config', help='Write a fmg_discovery config file for the simulator to the file')
+    args = parser.parse_args()
+
+    device_data = device_rows(args.devices, args.adoms, args.seed)
+    if args.config:
+        with open(args.config, 'w') as config_file:
+            yaml.safe_dump(simulator_config(f"http://{args.host}:{args.port}", device_data), config_file)
+    simulator = FmgSimulator(device_data, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                             error_code=args.error_code, session_ttl=args.session_ttl, seed=args.seed)
+    web.run_app(simulator.app(), host=args.host, port=args.port)
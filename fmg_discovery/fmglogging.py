@@ -20,17 +20,28 @@
 """
 
 
+import atexit
 import datetime
 import logging
+import logging.handlers
 import numbers
 import os
+import queue
 import sys
-from typing import Any
+import threading
+from typing import Any, Dict, Optional
 
 from dateutil.tz import tzutc
 from fmg_discovery.environments import FMG_DISCOVERY_LOG_LEVEL, FMG_DISCOVERY_LOG_FILE
 
 MESSAGE = 'message'
+# All loggers of the package are children of this logger and share its handler
+PACKAGE_LOGGER = 'fmg_discovery'
+DEFAULT_LEVEL = 'WARNING'
+
+_configure_lock = threading.Lock()
+_queue_handler: Optional[logging.handlers.QueueHandler] = None
+_listener: Optional[logging.handlers.QueueListener] = None
 
 
 class Iso8601UTCTimeFormatter(logging.Formatter):
@@ -54,22 +65,98 @@ class Iso8601UTCTimeFormatter(logging.Formatter):
             timespec='milliseconds')).replace('+00:00', 'Z')
 
 
+def configure_logging() -> logging.handlers.QueueHandler:
+    """
+    Configure the logging handlers, only done once. Records are put on a queue and written to the log file, or
+    stdout, by a background thread, so logging never blocks the event loop on I/O.
+    :return: the queue handler shared by all loggers
+    """
+    global _queue_handler, _listener
+    with _configure_lock:
+        if _queue_handler is not None:
+            return _queue_handler
+
+        formatter = Iso8601UTCTimeFormatter('timestamp=%(asctime)s level=%(levelname)s %(message)s')
+        try:
+            hdlr = logging.FileHandler(os.getenv(FMG_DISCOVERY_LOG_FILE)) if os.getenv(FMG_DISCOVERY_LOG_FILE) \
+                else logging.StreamHandler(sys.stdout)
+        except Exception:
+            hdlr = logging.StreamHandler(sys.stdout)
+        hdlr.setFormatter(formatter)
+
+        _queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+        _listener = logging.handlers.QueueListener(_queue_handler.queue, hdlr)
+        _listener.start()
+        # Write the records left in the queue on exit
+        atexit.register(_listener.stop)
+
+        _add_handler(logging.getLogger(PACKAGE_LOGGER), _queue_handler)
+        return _queue_handler
+
+
+def _add_handler(logger: logging.Logger, handler: logging.Handler):
+    logger.addHandler(handler)
+    # The records are only written by the own handler, not again by the handlers of the root logger
+    logger.propagate = False
+    try:
+        logger.setLevel(os.getenv(FMG_DISCOVERY_LOG_LEVEL, DEFAULT_LEVEL))
+    except ValueError:
+        logger.setLevel(DEFAULT_LEVEL)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Get a configured logger. Loggers of the package use the handler of the package logger, other loggers get the
+    same handler added once.
+    :param name:
+    :return:
+    """
+    handler = configure_logging()
+    logger = logging.getLogger(name)
+    if name != PACKAGE_LOGGER and not name.startswith(f"{PACKAGE_LOGGER}.") and handler not in logger.handlers:
+        _add_handler(logger, handler)
+    return logger
+
+
+def format_value(value: Any) -> str:
+    if isinstance(value, numbers.Number):
+        return str(value)
+    value = str(value)
+    if '"' in value:
+        return '"' + value.replace('"', '\\"') + '"'
+    if ' ' in value:
+        return '"' + value + '"'
+    return value
+
+
 class Log:
 
     def __init__(self, name):
         self.logger = self.configure_logger(name)
 
+    def is_enabled(self, level: int) -> bool:
+        """
+        Check if the level is enabled, use it to not build the log entry of a disabled level
+        :param level: the logging level, like logging.DEBUG
+        :return:
+        """
+        return self.logger.isEnabledFor(level)
+
     def error(self, message):
-        self.error_fmt({MESSAGE: message})
+        if self.logger.isEnabledFor(logging.ERROR):
+            self.logger.error(f"{MESSAGE}={format_value(message)}")
 
     def warn(self, message):
-        self.warn_fmt({MESSAGE: message})
+        if self.logger.isEnabledFor(logging.WARNING):
+            self.logger.warning(f"{MESSAGE}={format_value(message)}")
 
     def info(self, message):
-        self.info_fmt({MESSAGE: message})
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(f"{MESSAGE}={format_value(message)}")
 
     def debug(self, message):
-        self.debug_fmt({MESSAGE: message})
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f"{MESSAGE}={format_value(message)}")
 
     def operation(self, oper: str, mesg: str, level: str = 'INFO', id: Any = None):
         log_kv = {'operation': oper, MESSAGE: mesg, 'id': id}
@@ -81,72 +168,32 @@ class Log:
             self.error_fmt(log_kv)
 
     def info_fmt(self, log_kv: dict):
-        fmt = self._format(log_kv)
-        self.logger.info(fmt)
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(self._format(log_kv))
 
     def warn_fmt(self, log_kv: dict):
-        fmt = self._format(log_kv)
-        self.logger.warning(fmt)
+        if self.logger.isEnabledFor(logging.WARNING):
+            self.logger.warning(self._format(log_kv))
 
     def error_fmt(self, log_kv: dict):
-        fmt = self._format(log_kv)
-        self.logger.error(fmt)
+        if self.logger.isEnabledFor(logging.ERROR):
+            self.logger.error(self._format(log_kv))
 
     def debug_fmt(self, log_kv: dict):
-        fmt = self._format(log_kv)
-        self.logger.debug(fmt)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(self._format(log_kv))
 
-    def _format(self, log_kv):
-        fmt = ''
-        sep = ''
+    @staticmethod
+    def _format(log_kv: Dict[str, Any]) -> str:
         try:
-            for k, v in log_kv.items():
-                if v is not None:
-                    if isinstance(v, numbers.Number):
-                        fmt = f"{fmt}{sep}{k}={str(v)}"
-                    elif ' ' in v or '"' in v:
-                        if '"' in v:
-                            j = v.replace('"', '\\"')
-                            fmt = f"{fmt}{sep}{k}=\"{j}\""
-                        else:
-                            fmt = f"{fmt}{sep}{k}=\"{v}\""
-                    else:
-                        fmt = f"{fmt}{sep}{k}={v}"
-                sep = ' '
-            return fmt
+            return ' '.join([f"{k}={format_value(v)}" for k, v in log_kv.items() if v is not None])
         except Exception as err:
             return f"exception=\"{err}\" description=\"Parsing log entry\""
 
     def info_timer(self, method, path, time, status=None, remote_address: str = None):
-        self.info_fmt({'address': remote_address, 'method': method, 'path': path, 'status': status,
-                       'response_time': time})
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(self._format({'address': remote_address, 'method': method, 'path': path,
+                                           'status': status, 'response_time': time}))
 
     def configure_logger(self, name):
-        formatter = Iso8601UTCTimeFormatter('timestamp=%(asctime)s level=%(levelname)s %(message)s')
-
-        logger = logging.getLogger(name)
-        try:
-
-            if os.getenv(FMG_DISCOVERY_LOG_FILE):
-                hdlr = logging.FileHandler(os.getenv(FMG_DISCOVERY_LOG_FILE))
-            else:
-                hdlr = logging.StreamHandler(sys.stdout)
-
-            hdlr.setFormatter(formatter)
-            logger.addHandler(hdlr)
-
-            logger.setLevel(os.getenv(FMG_DISCOVERY_LOG_LEVEL, 'WARNING'))
-
-        except Exception:
-
-            hdlr = logging.StreamHandler(sys.stdout)
-            if os.getenv(FMG_DISCOVERY_LOG_FILE):
-                hdlr = logging.FileHandler(os.getenv(FMG_DISCOVERY_LOG_FILE))
-
-            hdlr.setFormatter(formatter)
-            logger.addHandler(hdlr)
-            logger.setLevel('WARNING')
-            if os.getenv(FMG_DISCOVERY_LOG_LEVEL):
-                logger.setLevel(os.getenv(FMG_DISCOVERY_LOG_LEVEL))
-
-        return logger
+        return get_logger(name)
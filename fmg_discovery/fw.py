@@ -19,50 +19,86 @@
 
 """
 
-from typing import Dict, List, Any, Tuple
+from types import MappingProxyType
+from typing import Dict, List, Any, Tuple, Mapping, Optional
 import ipaddress
 
+META_LABEL_PREFIX = '__meta_fortigate_'
+
 
 def meta_label_name(name: str) -> str:
-    return f"{Fortigate.meta_label_prefix}{name}"
+    return f"{META_LABEL_PREFIX}{name}"
+
+
+# Precomputed label names
+LABEL_NAME = meta_label_name('name')
+LABEL_ADOM = meta_label_name('adom')
+LABEL_FMG = meta_label_name('fmg')
+LABEL_SN = meta_label_name('sn')
+LABEL_LATITUDE = meta_label_name('latitude')
+LABEL_LONGITUDE = meta_label_name('longitude')
+LABEL_PLATFORM = meta_label_name('platform')
+LABEL_TOKEN = meta_label_name('token')
+LABEL_PROFILE = meta_label_name('profile')
+
+EMPTY_LABELS: Mapping[str, str] = MappingProxyType({})
 
 
 class Fortigate:
-    meta_label_prefix = '__meta_fortigate_'
-
-    def __init__(self, name: str, ip: str):
-        self.name: str = name.strip()
-        self.ip: str = ip.strip()
-        self.token: str = ''
-        self.port: int = 443
-        self.adom: str = ''
-        self.latitude: str = ''
-        self.longitude: str = ''
-        self.platform: str = ''
-        self.labels: Dict[str, str] = {meta_label_name('name'): self.name}
-        self.profile: str = ''
-
-        self.conf_status: str = ''
-        self.conn_mode: str = ''
-        self.conn_status: str = ''
-        self.desc: str = ''
-        self.ha_group_id: str = ''
-        self.ha_group_name: str = ''
-        self.ha_mode: str = ''
-        self.ha_slave: List[Dict[str, Any]] = []
+    """
+    A immutable Fortigate. The labels are the adom labels, shared by all Fortigates in the same adom.
+    """
+    meta_label_prefix = META_LABEL_PREFIX
+
+    __slots__ = ('name', 'ip', 'token', 'port', 'adom', 'latitude', 'longitude', 'platform', 'labels', 'profile',
+                 'conf_status', 'conn_mode', 'conn_status', 'desc', 'ha_group_id', 'ha_group_name', 'ha_mode',
+                 'ha_slave', 'fmg', 'sn', '_prometheus_file_sd_entry')
+
+    def __init__(self, name: str, ip: str, token: str = '', port: int = 443, adom: str = '', latitude: str = '',
+                 longitude: str = '', platform: str = '', labels: Mapping[str, str] = EMPTY_LABELS,
+                 profile: str = '', conf_status: str = '', conn_mode: str = '', conn_status: str = '',
+                 desc: str = '', ha_group_id: str = '', ha_group_name: str = '', ha_mode: str = '',
+                 ha_slave: Tuple[Dict[str, Any], ...] = (), fmg: str = '', sn: str = ''):
+        setattr_ = object.__setattr__
+        setattr_(self, 'name', name.strip())
+        setattr_(self, 'ip', ip.strip())
+        setattr_(self, 'token', token)
+        setattr_(self, 'port', port)
+        setattr_(self, 'adom', adom)
+        setattr_(self, 'latitude', latitude)
+        setattr_(self, 'longitude', longitude)
+        setattr_(self, 'platform', platform)
+        setattr_(self, 'labels', labels)
+        setattr_(self, 'profile', profile)
+
+        setattr_(self, 'conf_status', conf_status)
+        setattr_(self, 'conn_mode', conn_mode)
+        setattr_(self, 'conn_status', conn_status)
+        setattr_(self, 'desc', desc)
+        setattr_(self, 'ha_group_id', ha_group_id)
+        setattr_(self, 'ha_group_name', ha_group_name)
+        setattr_(self, 'ha_mode', ha_mode)
+        setattr_(self, 'ha_slave', tuple(ha_slave))
+        setattr_(self, 'fmg', fmg)
+        setattr_(self, 'sn', sn)
+        setattr_(self, '_prometheus_file_sd_entry', None)
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"Fortigate is immutable, can not set {key}")
 
     def _as_labels(self) -> Dict[str, str]:
 
-        labels = self.labels.copy()
-        labels[meta_label_name('adom')] = self.adom
-        labels[meta_label_name('latitude')] = self.latitude
-        labels[meta_label_name('longitude')] = self.longitude
-        labels[meta_label_name('platform')] = self.platform
+        labels = {LABEL_NAME: self.name, **self.labels, LABEL_ADOM: self.adom, LABEL_LATITUDE: self.latitude,
+                  LABEL_LONGITUDE: self.longitude, LABEL_PLATFORM: self.platform}
 
+        if self.fmg:
+            labels[LABEL_FMG] = self.fmg
+        if self.sn:
+            labels[LABEL_SN] = self.sn
         if self.token:
-            labels[meta_label_name('token')] = self.token
+            labels[LABEL_TOKEN] = self.token
         if self.profile:
-            labels[meta_label_name('profile')] = self.profile
+            labels[LABEL_PROFILE] = self.profile
 
         return labels
 
@@ -88,34 +124,59 @@ class Fortigate:
         return valid, cause
 
     def as_prometheus_file_sd_entry(self) -> Dict[str, Any]:
-        return {'targets': [f"https://{self.ip}:{self.port}"], 'labels': self._as_labels()}
-
-
-def fw_factory(adom, device) -> Fortigate:
-    fw = Fortigate(name=device['name'], ip=device['ip'])
-    # Discovery
-    fw.latitude = device['latitude'].strip()
-    fw.longitude = device['longitude'].strip()
-    fw.platform = device['platform_str'].strip()
-    fw.adom = adom['name']
-    if 'labels' in adom:
-        for label_key, label_value in adom['labels'].items():
-            fw.labels[meta_label_name(label_key)] = label_value
-    if 'token' in adom['fortigate']:
-        fw.token = adom['fortigate']['token']
-    if 'port' in adom['fortigate']:
-        fw.port = adom['fortigate']['port']
-    if 'profile' in adom['fortigate']:
-        fw.profile = adom['fortigate']['profile']
-
-    fw.conf_status = device['conf_status'].strip()
-    fw.conn_mode = device['conn_mode'].strip()
-    fw.conn_status = device['conn_status'].strip()
-    fw.desc = device['desc'].strip()
-    fw.ha_group_id = str(device['ha_group_id']).strip()
-    fw.ha_group_name = device['ha_group_name'].strip()
-    fw.ha_mode = device['ha_mode'].strip()
+        """
+        The file sd entry is only created once, the returned dict must not be modified
+        :return:
+        """
+        if self._prometheus_file_sd_entry is None:
+            object.__setattr__(self, '_prometheus_file_sd_entry',
+                               {'targets': [f"https://{self.ip}:{self.port}"], 'labels': self._as_labels()})
+        return self._prometheus_file_sd_entry
+
+
+def adom_labels(adom: Dict[str, Any]) -> Mapping[str, str]:
+    """
+    Create the labels of the adom, the returned labels should be shared by all Fortigates in the adom
+    :param adom: the adom configuration
+    :return: a read only mapping
+    """
+    if 'labels' not in adom:
+        return EMPTY_LABELS
+    return MappingProxyType({meta_label_name(label_key): label_value
+                             for label_key, label_value in adom['labels'].items()})
+
+
+def fw_factory(adom, device, labels: Optional[Mapping[str, str]] = None) -> Fortigate:
+    """
+    Create a Fortigate from the FortiManager device
+    :param adom: the adom configuration
+    :param device: the device from FortiManager
+    :param labels: the shared adom labels, created from the adom configuration if not set
+    :return:
+    """
+    fortigate = adom['fortigate']
+    ha_slave: List[Dict[str, Any]] = []
     if device['ha_slave'] and isinstance(device['ha_slave'], list):
-        fw.ha_slave.extend(device['ha_slave'])
-
-    return fw
+        ha_slave = device['ha_slave']
+
+    return Fortigate(name=device['name'], ip=device['ip'],
+                     # Discovery
+                     latitude=device['latitude'].strip(),
+                     longitude=device['longitude'].strip(),
+                     platform=device['platform_str'].strip(),
+                     adom=adom['name'],
+                     labels=adom_labels(adom) if labels is None else labels,
+                     token=fortigate.get('token', ''),
+                     port=fortigate.get('port', 443),
+                     profile=fortigate.get('profile', ''),
+
+                     conf_status=device['conf_status'].strip(),
+                     conn_mode=device['conn_mode'].strip(),
+                     conn_status=device['conn_status'].strip(),
+                     desc=device['desc'].strip(),
+                     ha_group_id=str(device['ha_group_id']).strip(),
+                     ha_group_name=device['ha_group_name'].strip(),
+                     ha_mode=device['ha_mode'].strip(),
+                     ha_slave=ha_slave,
+                     fmg=adom.get('fmg', ''),
+                     sn=str(device.get('sn') or '').strip())
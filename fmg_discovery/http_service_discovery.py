@@ -24,39 +24,53 @@
     - generate_latest
 
 """
-import json
+import asyncio
 import logging.config as lc
 import math
 import os
+import random
 import secrets
 import sys
 import time
-from typing import List, Any, Annotated, Dict
+from typing import List, Any, Annotated, Dict, Callable, Awaitable, Optional, Tuple, AsyncIterator
 
 import uvicorn
 import yaml
-from fastapi import FastAPI, Request, Response, Depends, HTTPException, status
+from fastapi import FastAPI, Request, Response, Depends, HTTPException, Query, status
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from prometheus_client import CollectorRegistry, Gauge
+from prometheus_client import Counter, Histogram, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
 from prometheus_client.exposition import CONTENT_TYPE_LATEST
 from prometheus_client.utils import INF, MINUS_INF
 from prometheus_fastapi_instrumentator import Instrumentator
 
 from fmg_discovery.environments import FMG_DISCOVERY_BASIC_AUTH_USERNAME, FMG_DISCOVERY_BASIC_AUTH_PASSWORD, \
     FMG_DISCOVERY_BASIC_AUTH_ENABLED, FMG_DISCOVERY_LOG_LEVEL, FMG_DISCOVERY_HOST, FMG_DISCOVERY_PORT, \
-    FMG_DISCOVERY_CACHE_TTL
+    FMG_DISCOVERY_CACHE_TTL, FMG_DISCOVERY_CACHE_JITTER, FMG_DISCOVERY_CACHE_MAX_STALENESS, \
+    FMG_DISCOVERY_CACHE_NEGATIVE_TTL, FMG_DISCOVERY_SNAPSHOT_FILE, FMG_DISCOVERY_SHARD_BY, \
+    FMG_DISCOVERY_PROFILING_ENABLED
 
+from fmg_discovery import json_codec
+from fmg_discovery.compression import negotiate
 from fmg_discovery.environments import FMG_DISCOVERY_CONFIG
 from fmg_discovery.exceptions import FmgException
-from fmg_discovery.fmg_api import FMG
-from fmg_discovery.fmg_collector import FmgCollector
+from fmg_discovery.fmg_federation import FederatedFMG, configured_adoms, adom_key
+from fmg_discovery.fmg_metrics import FmgMetricColumns, iter_metrics
 from fmg_discovery.fmglogging import Log
 from fmg_discovery.fw import Fortigate
+from fmg_discovery.profiling import sample, profile, pstats_dump, pstats_text
+from fmg_discovery.sharding import SHARD_BY_NAME, shard_hashes, partition
+from fmg_discovery.snapshot import Snapshot, FragmentCache, etag_match, normalize_query, MAX_PARTITIONS
+from fmg_discovery.snapshot_file import save_snapshot, load_snapshot
 
 FORMAT = 'timestamp="%(asctime)s" level=%(levelname)s module="%(module)s" %(message)s'
 TIME_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
 lc.dictConfig({
     'version': 1,
+    # The loggers of the package are configured by fmglogging and must not be disabled
+    'disable_existing_loggers': False,
     'formatters': {'default': {
         'format': FORMAT,
         'datefmt': TIME_FORMAT
@@ -74,8 +88,37 @@ lc.dictConfig({
 
 MIME_TYPE_TEXT_HTML = 'text/html'
 MIME_TYPE_APPLICATION_JSON = 'application/json'
+# Max size of the chunks when small rendered chunks are joined before they are streamed
+STREAM_CHUNK_SIZE = 64 * 1024
 log = Log(__name__)
 
+# Max number of shards of /prometheus-sd-targets
+MAX_SHARDS = 1024
+# Max number of seconds of a time-boxed profile
+MAX_PROFILE_SECONDS = 60
+PROFILE_MODES = ('sample', 'cprofile')
+PROFILE_FORMATS = ('text', 'pstats')
+
+# The single flight key for refreshing the expired adoms
+SNAPSHOT_KEY = 'snapshot'
+
+CACHE_REFRESHES = Counter('fmg_discovery_cache_refreshes', 'Number of cache refreshes started')
+CACHE_COALESCED = Counter('fmg_discovery_cache_coalesced', 'Number of callers that waited on an already running '
+                                                           'cache refresh instead of starting a new one')
+CACHE_HITS = Counter('fmg_discovery_cache_hits', 'Number of requests served without fetching from FortiManager')
+CACHE_MISSES = Counter('fmg_discovery_cache_misses', 'Number of requests that had to wait for adoms never fetched '
+                                                     'from FortiManager')
+REFRESH_DURATION = Histogram('fmg_discovery_cache_refresh_duration_seconds',
+                             'Duration of refreshing the expired adoms from FortiManager')
+
+# The rendered fragments of unchanged adoms are reused between snapshots
+fragment_cache = FragmentCache()
+# The discovery fragments of the shards per number of shards, only kept for the most recently used numbers of shards
+shard_fragment_cache = FragmentCache(max_names=MAX_PARTITIONS)
+
+# Only one profile can run at the time
+profile_lock = asyncio.Lock()
+
 app = FastAPI()
 
 # Enable auto instrumentation
@@ -138,23 +181,344 @@ class Config(metaclass=Singleton):
         return self.config
 
 
+class CacheEntry:
+    """
+    The last known good Fortigates of an adom
+    """
+
+    def __init__(self, fws: List[Fortigate], ttl: float, fingerprint: Optional[str] = None,
+                 updated: Optional[float] = None):
+        now = time.time()
+        self.fws: List[Fortigate] = fws
+        self.fingerprint: Optional[str] = fingerprint
+        self.updated: float = now if updated is None else updated
+        self.expire: float = now + ttl
+
+
 class Cache(metaclass=Singleton):
+    """
+    Hold the Fortigates per adom. Each adom is refreshed in the background when its ttl expire, and the last known
+    good Fortigates are served until they are older than max staleness. A failed refresh is retried after the
+    negative ttl.
+    An adom without good Fortigates, never fetched or older than max staleness, is left out of the snapshot. If no
+    adom has good Fortigates no snapshot is served at all, since Prometheus drops all targets on an empty result but
+    keeps its last targets on an error.
+    """
 
     def __init__(self):
         self._ttl: int = int(os.getenv(FMG_DISCOVERY_CACHE_TTL, "60"))
-        self._expire: int = 0
-        self._cache: Dict[str, Any] = {}
+        self._negative_ttl: int = int(os.getenv(FMG_DISCOVERY_CACHE_NEGATIVE_TTL, "10"))
+        self._jitter: float = float(os.getenv(FMG_DISCOVERY_CACHE_JITTER, "0.1"))
+        self._max_staleness: int = max(self._ttl, int(os.getenv(FMG_DISCOVERY_CACHE_MAX_STALENESS, "600")))
+        self._cache: Dict[str, CacheEntry] = {}
+        # The time to retry adoms whose last refresh failed, separate from the last good entries
+        self._failed: Dict[str, float] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # Incremented every time the cached Fortigates change
+        self._generation: int = 0
+        self._snapshot: Optional[Snapshot] = None
+        self._snapshot_key: Tuple = ()
+
+    def ttl(self, adom: Dict[str, Any]) -> int:
+        """
+        The ttl of the adom, the adom configuration cache_ttl override the default
+        :param adom: the adom configuration
+        :return:
+        """
+        return int(adom.get('cache_ttl', self._ttl))
+
+    def put(self, adom_name: str, fws: List[Fortigate], ttl: int, fingerprint: Optional[str] = None):
+        """
+        Put the Fortigates of the adom. If the fingerprint is the same as the cached, only the expire time is
+        updated and the snapshot is not changed.
+        """
+        entry = self._cache.get(adom_name)
+        unchanged = entry is not None and fingerprint is not None and entry.fingerprint == fingerprint
+        self._cache[adom_name] = CacheEntry(entry.fws if unchanged else fws, ttl, fingerprint)
+        self._failed.pop(adom_name, None)
+        if not unchanged:
+            self._generation += 1
+
+    def load(self, adoms: Dict[str, Tuple[Optional[str], List[Fortigate]]], updated: Dict[str, float]):
+        """
+        Load Fortigates from a saved snapshot. The entries keep the time they were last fetched and expire directly,
+        so they are replaced by the first successful refresh, and are only served until they are older than max
+        staleness.
+        :param adoms: the fingerprint and Fortigates per adom
+        :param updated: the time the Fortigates of each adom were last fetched successfully
+        :return:
+        """
+        for adom_name, (fingerprint, fws) in adoms.items():
+            self._cache[adom_name] = CacheEntry(fws, 0, fingerprint, updated=updated.get(adom_name, 0))
+        self._generation += 1
+
+    def good_entries(self) -> Dict[str, Tuple[Optional[str], List[Fortigate]]]:
+        """
+        Get the fingerprint and Fortigates of all adoms that has been refreshed successfully
+        :return:
+        """
+        return {adom_name: (entry.fingerprint, entry.fws) for adom_name, entry in self._cache.items()}
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def expire_all(self):
+        """
+        Expire all adoms so they are refreshed by the next refresh
+        :return:
+        """
+        for entry in self._cache.values():
+            entry.expire = 0
+        for adom_name in self._failed:
+            self._failed[adom_name] = 0
+
+    def updated(self) -> Dict[str, float]:
+        """
+        The time of the last good Fortigates of each adom, adoms that has never been good are not included
+        :return:
+        """
+        return {adom_name: entry.updated for adom_name, entry in self._cache.items()}
+
+    def ages(self) -> Dict[str, float]:
+        """
+        The age in seconds of the last good Fortigates of each adom, adoms that has never been good are not included
+        :return:
+        """
+        now = time.time()
+        return {adom_name: now - entry.updated for adom_name, entry in self._cache.items()}
+
+    def failed(self) -> List[str]:
+        """
+        The adoms whose last refresh failed
+        :return:
+        """
+        return list(self._failed)
+
+    def put_failed(self, adom_name: str):
+        """
+        Register a failed refresh of the adom. The last known good entry is kept, and a new refresh is done after
+        the negative ttl.
+        :param adom_name:
+        :return:
+        """
+        self._failed[adom_name] = time.time() + self._negative_ttl
+
+    def _stale(self, entry: CacheEntry) -> bool:
+        # An adom with a ttl above max staleness is not stale before its refresh is due
+        return time.time() - entry.updated >= max(self._max_staleness, entry.expire - entry.updated)
+
+    def get(self, adom_names: List[str]) -> Snapshot:
+        """
+        Get a snapshot of the Fortigates of the adoms that has good Fortigates refreshed within max staleness. The
+        same snapshot is returned until the cached Fortigates, or the available adoms, change.
+        :param adom_names:
+        :return:
+        :raise FmgException: if no adom has good Fortigates refreshed within max staleness
+        """
+        available = [adom_name for adom_name in adom_names
+                     if adom_name in self._cache and not self._stale(self._cache[adom_name])]
+        if adom_names and not available:
+            raise FmgException(message=f"No good result within max staleness from FortiManager for adoms: "
+                                       f"{', '.join(adom_names)}")
+
+        snapshot_key = (self._generation, tuple(available))
+        if self._snapshot is None or snapshot_key != self._snapshot_key:
+            fws: Dict[str, List[Fortigate]] = {}
+            fingerprints: Dict[str, str] = {}
+            for adom_name in available:
+                fws[adom_name] = self._cache[adom_name].fws
+                if self._cache[adom_name].fingerprint is not None:
+                    fingerprints[adom_name] = self._cache[adom_name].fingerprint
+            self._snapshot = Snapshot(self._generation, fws, fingerprints)
+            self._snapshot_key = snapshot_key
+        return self._snapshot
+
+    def missing(self, adom_names: List[str]) -> List[str]:
+        """
+        Get the adoms that has never been refreshed, successfully or not
+        :param adom_names:
+        :return:
+        """
+        missing = [adom_name for adom_name in adom_names
+                   if adom_name not in self._cache and adom_name not in self._failed]
+        if missing:
+            CACHE_MISSES.inc()
+        else:
+            CACHE_HITS.inc()
+        return missing
+
+    def expired(self, adom_names: List[str]) -> List[str]:
+        """
+        Get the adoms that should be refreshed
+        :param adom_names:
+        :return:
+        """
+        now = time.time()
+        return [adom_name for adom_name in adom_names if now >= self._retry(adom_name)]
+
+    def _retry(self, adom_name: str) -> float:
+        # The time the adom should be refreshed, a failed refresh is retried after the negative ttl
+        if adom_name in self._failed:
+            return self._failed[adom_name]
+        if adom_name in self._cache:
+            return self._cache[adom_name].expire
+        return 0
+
+    def next_refresh(self) -> float:
+        """
+        The number of seconds until the next adom expire, with a random jitter
+        :return:
+        """
+        adom_names = set(self._cache) | set(self._failed)
+        if not adom_names:
+            delay = self._ttl
+        else:
+            delay = max(1.0, min(self._retry(adom_name) for adom_name in adom_names) - time.time())
+        return delay * (1 + random.uniform(0, self._jitter))
+
+    async def single_flight(self, key: str, refresh_function: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run refresh_function for the key unless a refresh for the same key is already running, in that case
+        wait for the result of the running refresh.
+        :param key: the cache key
+        :param refresh_function: the coroutine function doing the refresh
+        :return: the result of the refresh
+        """
+        task = self._inflight.get(key)
+        if task is not None:
+            CACHE_COALESCED.inc()
+        else:
+            CACHE_REFRESHES.inc()
+            task = asyncio.ensure_future(refresh_function())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shield so a cancelled caller do not cancel the refresh for the other callers
+        return await asyncio.shield(task)
 
-    def put(self, data: Dict[str, List[Fortigate]]):
-        self._expire = time.time() + self._ttl
-        self._cache = data
 
-    def get(self) -> Dict[str, List[Fortigate]]:
-        if time.time() < self._expire:
-            log.info_fmt({"operation": "cache", "hit": True})
-            return self._cache
-        log.info_fmt({"operation": "cache", "hit": False})
-        return {}
+class CacheCollector(Collector):
+    """
+    Collect the state of the cache when /exporter-metrics is scraped
+    """
+
+    def collect(self):
+        cache = Cache()
+        age = GaugeMetricFamily('fmg_discovery_cache_age_seconds', 'Age of the last good result of the adom',
+                                labels=['adom'])
+        for adom_name, adom_age in cache.ages().items():
+            age.add_metric([adom_name], adom_age)
+        yield age
+        failed = GaugeMetricFamily('fmg_discovery_cache_failed', 'The last refresh of the adom failed',
+                                   labels=['adom'])
+        for adom_name in cache.failed():
+            failed.add_metric([adom_name], 1)
+        yield failed
+        yield GaugeMetricFamily('fmg_discovery_cache_generation', 'The generation of the cached result, incremented '
+                                                                  'every time the result change',
+                                value=cache.generation)
+
+
+REGISTRY.register(CacheCollector())
+
+
+def adom_names() -> List[str]:
+    return [adom_key(adom) for adom in configured_adoms(Config().get())]
+
+
+async def refresh():
+    """
+    Refresh the expired adoms. Adoms that fail keep their last known good Fortigates.
+    :return:
+    """
+    async def fetch():
+        cache = Cache()
+        expired = cache.expired(adom_names())
+        adoms = [adom for adom in configured_adoms(Config().get()) if adom_key(adom) in expired]
+        if not adoms:
+            return
+        with REFRESH_DURATION.time():
+            await fetch_adoms(cache, adoms)
+
+    async def fetch_adoms(cache: Cache, adoms: List[Dict[str, Any]]):
+        try:
+            fws = await app.state.fmg.get_fmg_devices(adoms)
+        except Exception:
+            for adom in adoms:
+                cache.put_failed(adom_key(adom))
+            raise
+
+        for adom in adoms:
+            if adom_key(adom) in fws:
+                cache.put(adom_key(adom), fws[adom_key(adom)], cache.ttl(adom),
+                          app.state.fmg.fingerprints.get(adom_key(adom)))
+            else:
+                cache.put_failed(adom_key(adom))
+
+        # Also saved if unchanged, so the time of the last good result is kept in the snapshot
+        if os.getenv(FMG_DISCOVERY_SNAPSHOT_FILE) and fws:
+            await persist_snapshot(cache)
+
+    await Cache().single_flight(SNAPSHOT_KEY, fetch)
+
+
+async def persist_snapshot(cache: Cache):
+    """
+    Save the good entries of the cache to the snapshot file, the file is written in a separate thread to not block
+    the event loop
+    """
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, save_snapshot, os.getenv(FMG_DISCOVERY_SNAPSHOT_FILE),
+                                                         cache.good_entries(), cache.updated())
+    except Exception as err:
+        log.error(f"Failed to save snapshot to {os.getenv(FMG_DISCOVERY_SNAPSHOT_FILE)} - err: {str(err)}")
+
+
+def warm_start():
+    """
+    Load the cache from the snapshot file, if configured
+    """
+    if not os.getenv(FMG_DISCOVERY_SNAPSHOT_FILE):
+        return
+    try:
+        names = adom_names()
+        updated, adoms = load_snapshot(os.getenv(FMG_DISCOVERY_SNAPSHOT_FILE))
+        Cache().load({adom_name: adom for adom_name, adom in adoms.items() if adom_name in names}, updated)
+        log.info_fmt({'operation': 'warm_start', 'adoms': len(adoms),
+                      'age': round(time.time() - min(updated.values(), default=time.time()), 3)})
+    except Exception as err:
+        log.error(f"Failed to load snapshot from {os.getenv(FMG_DISCOVERY_SNAPSHOT_FILE)} - err: {str(err)}")
+
+
+async def background_refresh():
+    """
+    Refresh the cache when adoms expire. A failed refresh keep the last good entries in the cache.
+    :return:
+    """
+    cache = Cache()
+    while True:
+        try:
+            await refresh()
+        except asyncio.CancelledError:
+            raise
+        except FmgException as err:
+            log.error(f"Background refresh failed - err: {err.message}")
+        except Exception as err:
+            log.error(f"Background refresh failed - err: {str(err)}")
+        await asyncio.sleep(cache.next_refresh())
+
+
+async def get_snapshot() -> Snapshot:
+    """
+    Get the snapshot of Fortigates from the cache, only adoms that has never been refreshed are fetched directly
+    from the FortiManager
+    :return:
+    """
+    cache = Cache()
+    names = adom_names()
+    if cache.missing(names):
+        await refresh()
+    return cache.get(names)
 
 
 def floatToGoString(d):
@@ -244,36 +608,113 @@ def generate_latest(metrics_list: list):
     return ''.join(output).encode('utf-8')
 
 
+@app.on_event("startup")
+async def startup():
+    # One long-lived client per FortiManager with a pooled connection and a reused session
+    app.state.fmg = FederatedFMG(Config().get())
+    warm_start()
+    app.state.refresher = asyncio.create_task(background_refresh())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.refresher.cancel()
+    try:
+        await app.state.refresher
+    except asyncio.CancelledError:
+        pass
+    await app.state.fmg.close()
+
+
 @app.get('/')
 def alive(request: Request):
     request.app.state.users_events_counter.inc({"path": request.scope["path"]})
     return Response("fmg_discovery alive!", status_code=status.HTTP_200_OK, media_type=MIME_TYPE_TEXT_HTML)
 
 
-@app.get('/metrics')
-async def get_metrics():
-    start_time = time.time()
-    cache = Cache()
-    fws = cache.get()
-    if not fws:
-        fmg = FMG(Config().get())
-        fws = fmg.get_fmg_devices()
-        cache.put(fws)
+async def render_metrics(snapshot: Snapshot) -> List[bytes]:
+    columns = [fragment_cache.get('metrics', adom_name, snapshot.fingerprints.get(adom_name),
+                                  lambda: FmgMetricColumns(adom_fws))
+               for adom_name, adom_fws in snapshot.fws.items()]
+    return list(iter_metrics(columns))
+
+
+async def render_discovery(snapshot: Snapshot) -> List[bytes]:
+    def render_adom(adom_fws: List[Fortigate]) -> bytes:
+        # Encode the adom as a json list in one call and drop the brackets
+        return json_codec.dumps([fw.as_prometheus_file_sd_entry() for fw in adom_fws])[1:-1]
+
+    cache, fragment_name, key_prefix = fragment_cache, 'discovery', ''
+    if snapshot.partition:
+        # Each shard has its own fragments, kept together with the other shards of the same number of shards
+        shard, shards = snapshot.partition.split('-')
+        cache, fragment_name, key_prefix = shard_fragment_cache, f"discovery-{shards}", f"{shard}/"
+    chunks = [b'[']
+    for adom_name, adom_fws in snapshot.fws.items():
+        fragment = cache.get(fragment_name, f"{key_prefix}{adom_name}", snapshot.fingerprints.get(adom_name),
+                             lambda: render_adom(adom_fws))
+        if fragment:
+            if len(chunks) > 1:
+                chunks.append(b',')
+            chunks.append(fragment)
+    chunks.append(b']')
+    return chunks
+
+
+def partition_adom(adom_name: str, fingerprint: Optional[str], adom_fws: List[Fortigate],
+                   shards: int) -> List[List[Fortigate]]:
+    """
+    Partition the Fortigates of the adom in shards, the shard hashes are only calculated when the adom change
+    """
+    hashes = fragment_cache.get('shard_hashes', adom_name, fingerprint,
+                                lambda: shard_hashes(adom_fws, os.getenv(FMG_DISCOVERY_SHARD_BY, SHARD_BY_NAME)))
+    return partition(adom_fws, hashes, shards)
 
-    registry = CollectorRegistry()
-    try:
-        fmg_collector = FmgCollector(fws)
 
-        registry.register(fmg_collector)
+async def stream_chunks(chunks: List[bytes]) -> AsyncIterator[bytes]:
+    """
+    Stream the chunks of a rendered body. Small chunks, like separators, are sent together with the next chunks up
+    to STREAM_CHUNK_SIZE.
+    """
+    buffer: List[bytes] = []
+    buffered = 0
+    for chunk in chunks:
+        if buffer and buffered + len(chunk) > STREAM_CHUNK_SIZE:
+            yield b''.join(buffer)
+            buffer = []
+            buffered = 0
+        if len(chunk) >= STREAM_CHUNK_SIZE:
+            yield chunk
+        else:
+            buffer.append(chunk)
+            buffered += len(chunk)
+    if buffer:
+        yield b''.join(buffer)
 
-        duration = Gauge('fmg_scrape_duration_seconds', 'Time spent processing request', registry=registry)
 
-        duration.set(time.time() - start_time)
+async def snapshot_response(request: Request, snapshot: Snapshot, name: str,
+                            render_function: Callable[[Snapshot], Awaitable[List[bytes]]],
+                            media_type: str) -> Response:
+    """
+    Create the streaming response for a rendered snapshot body, compressed according to the Accept-Encoding header,
+    or a 304 if the client already have it
+    """
+    encoding = negotiate(request.headers.get('accept-encoding'))
+    chunks, body_etag = await snapshot.render(name, render_function, encoding)
+    headers = {'ETag': body_etag, 'Last-Modified': snapshot.last_modified, 'Vary': 'Accept-Encoding'}
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    if etag_match(request.headers.get('if-none-match'), body_etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return StreamingResponse(stream_chunks(chunks), status_code=status.HTTP_200_OK, media_type=media_type,
+                             headers=headers)
 
-        fortigate_response = generate_latest(await fmg_collector.collect())
 
-        duration.set(time.time() - start_time)
-        return Response(fortigate_response, status_code=200, media_type=CONTENT_TYPE_LATEST)
+@app.get('/metrics')
+async def get_metrics(request: Request):
+    try:
+        snapshot = await get_snapshot()
+        return await snapshot_response(request, snapshot, 'metrics', render_metrics, CONTENT_TYPE_LATEST)
     except FmgException as err:
         log.error(err.message)
         return Response(err.message, status_code=err.status, media_type=MIME_TYPE_TEXT_HTML)
@@ -284,21 +725,79 @@ async def get_metrics():
 
 
 @app.get('/prometheus-sd-targets')
-def discovery(auth: Annotated[str, Depends(basic_auth)]):
-    cache = Cache()
-    fws = cache.get()
-    if not fws:
-        fmg = FMG(Config().get())
-        fws = fmg.get_fmg_devices()
-        cache.put(fws)
+async def discovery(request: Request, auth: Annotated[str, Depends(basic_auth)], shard: Optional[int] = None,
+                    shards: Optional[int] = None, adom: Annotated[Optional[List[str]], Query()] = None,
+                    platform: Annotated[Optional[List[str]], Query()] = None,
+                    conn_status: Annotated[Optional[List[str]], Query()] = None,
+                    label: Annotated[Optional[List[str]], Query()] = None):
+    if (shard is None) != (shards is None) or (shards is not None and not 0 <= shard < shards <= MAX_SHARDS):
+        return Response(f"Both shard and shards must be set and 0 <= shard < shards <= {MAX_SHARDS}",
+                        status_code=status.HTTP_400_BAD_REQUEST, media_type=MIME_TYPE_TEXT_HTML)
+    try:
+        query = normalize_query({'adom': adom, 'platform': platform, 'conn_status': conn_status}, label)
+    except ValueError as err:
+        return Response(str(err), status_code=status.HTTP_400_BAD_REQUEST, media_type=MIME_TYPE_TEXT_HTML)
+    try:
+        snapshot = await get_snapshot()
+    except FmgException as err:
+        log.error(err.message)
+        return Response(err.message, status_code=err.status, media_type=MIME_TYPE_TEXT_HTML)
+
+    snapshot = snapshot.filter(query)
+    if shards is not None:
+        snapshot = snapshot.shard(shard, shards, partition_adom)
 
-    prometheus_sd: List[Any] = []
-    for adom_name, fws in fws.items():
-        for fw in fws:
-            prometheus_sd.append(fw.as_prometheus_file_sd_entry())
+    return await snapshot_response(request, snapshot, 'discovery', render_discovery, MIME_TYPE_APPLICATION_JSON)
+
+
+async def forced_refresh():
+    """
+    Refresh all adoms and render the responses, without using any fingerprints or cached fragments, so all the
+    work of a refresh with new data is done
+    :return:
+    """
+    Cache().expire_all()
+    app.state.fmg.clear_fingerprints()
+    await refresh()
+    snapshot = await get_snapshot()
+    uncached = Snapshot(snapshot.generation, snapshot.fws)
+    await uncached.render('metrics', render_metrics, negotiate('gzip'))
+    await uncached.render('discovery', render_discovery, negotiate('gzip'))
+
+
+@app.get('/debug/profile')
+async def debug_profile(auth: Annotated[str, Depends(basic_auth)], mode: str = 'sample', seconds: float = 10,
+                        interval: float = 0.005, forced: Annotated[bool, Query(alias='refresh')] = False,
+                        output: Annotated[str, Query(alias='format')] = 'text'):
+    """
+    Profile the server, either time-boxed for a number of seconds or a single forced refresh
+    """
+    if os.getenv(FMG_DISCOVERY_PROFILING_ENABLED) != "true":
+        return Response("Profiling is not enabled", status_code=status.HTTP_404_NOT_FOUND,
+                        media_type=MIME_TYPE_TEXT_HTML)
+    if mode not in PROFILE_MODES or output not in PROFILE_FORMATS or not 0 < seconds <= MAX_PROFILE_SECONDS \
+            or not 0 < interval <= 1:
+        return Response(f"mode must be one of {', '.join(PROFILE_MODES)}, format one of {', '.join(PROFILE_FORMATS)}, "
+                        f"0 < seconds <= {MAX_PROFILE_SECONDS} and 0 < interval <= 1",
+                        status_code=status.HTTP_400_BAD_REQUEST, media_type=MIME_TYPE_TEXT_HTML)
+    if profile_lock.locked():
+        return Response("A profile is already running", status_code=status.HTTP_409_CONFLICT,
+                        media_type=MIME_TYPE_TEXT_HTML)
+
+    async with profile_lock:
+        target = forced_refresh if forced else lambda: asyncio.sleep(seconds)
+        try:
+            if mode == 'sample':
+                return Response(await sample(target, interval), media_type='text/plain')
+            profiler = await profile(target)
+        except FmgException as err:
+            log.error(err.message)
+            return Response(err.message, status_code=err.status, media_type=MIME_TYPE_TEXT_HTML)
 
-    targets = json.dumps(prometheus_sd, indent=4)
-    return Response(targets, status_code=status.HTTP_200_OK, media_type=MIME_TYPE_APPLICATION_JSON)
+    if output == 'pstats':
+        return Response(pstats_dump(profiler), media_type='application/octet-stream',
+                        headers={'Content-Disposition': 'attachment; filename="fmg_discovery.prof"'})
+    return Response(pstats_text(profiler), media_type='text/plain')
 
 
 def http_service_discovery():
@@ -309,5 +808,5 @@ def http_service_discovery():
     log_config["formatters"]["default"]['datefmt'] = TIME_FORMAT
     log_config["loggers"]["uvicorn.access"]["level"] = os.getenv(FMG_DISCOVERY_LOG_LEVEL, 'WARNING')
 
-    uvicorn.run(app, host=os.getenv(FMG_DISCOVERY_HOST, "0.0.0.0"), port=os.getenv(FMG_DISCOVERY_PORT, 9693),
+    uvicorn.run(app, host=os.getenv(FMG_DISCOVERY_HOST, "0.0.0.0"), port=int(os.getenv(FMG_DISCOVERY_PORT, 9693)),
                 log_config=log_config)
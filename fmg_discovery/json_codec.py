@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2023  Anders Håål
+
+    This file is part of fortigate-exporter-discovery.
+
+    fortigate-exporter-discovery is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    fortigate-exporter-discovery is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fortigate-exporter-discovery.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import json
+import os
+from typing import Any, Union, Optional
+
+from fmg_discovery.environments import FMG_DISCOVERY_JSON_CODEC
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+STDLIB = 'json'
+ORJSON = 'orjson'
+
+
+class JsonCodec:
+    """
+    The stdlib json codec. All encoded json is compact and utf-8 encoded.
+    """
+    name = STDLIB
+
+    def dumps(self, data: Any) -> bytes:
+        return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+    def dumps_sorted(self, data: Any) -> bytes:
+        """
+        Encode with the keys sorted, so the same data always is encoded the same
+        """
+        return json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """
+    The orjson codec, only available if orjson is installed
+    """
+    name = ORJSON
+
+    def dumps(self, data: Any) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+    def dumps_sorted(self, data: Any) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS)
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        return orjson.loads(data)
+
+
+def get_codec(name: Optional[str] = None) -> JsonCodec:
+    """
+    Get the json codec by name, default the codec set by FMG_DISCOVERY_JSON_CODEC, or orjson if installed
+    :param name: json or orjson
+    :return:
+    :raise ValueError: if the codec is not supported or not installed
+    """
+    name = name or os.getenv(FMG_DISCOVERY_JSON_CODEC)
+    if not name:
+        return OrjsonCodec() if orjson is not None else JsonCodec()
+    if name == STDLIB:
+        return JsonCodec()
+    if name == ORJSON:
+        if orjson is None:
+            raise ValueError(f"The json codec {ORJSON} is not installed")
+        return OrjsonCodec()
+    raise ValueError(f"Not supported json codec {name}, must be {STDLIB} or {ORJSON}")
+
+
+_codec: JsonCodec = get_codec()
+
+
+def use_codec(name: Optional[str] = None):
+    """
+    Change the json codec used by dumps, dumps_sorted and loads
+    :param name: see get_codec
+    :return:
+    """
+    global _codec
+    _codec = get_codec(name)
+
+
+def codec() -> JsonCodec:
+    return _codec
+
+
+def dumps(data: Any) -> bytes:
+    return _codec.dumps(data)
+
+
+def dumps_sorted(data: Any) -> bytes:
+    return _codec.dumps_sorted(data)
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    return _codec.loads(data)
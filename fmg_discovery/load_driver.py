@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2023  Anders Håål
+
+    This file is part of fortigate-exporter-discovery.
+
+    fortigate-exporter-discovery is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    fortigate-exporter-discovery is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fortigate-exporter-discovery.  If not, see <http://www.gnu.org/licenses/>.
+
+    A load driver for the discovery server, that request /metrics and /prometheus-sd-targets concurrently and report
+    the latency percentiles and throughput per path, and the number of FortiManager calls if the server use the
+    FortiManager simulator.
+
+    python -m fmg_discovery.load_driver --url http://localhost:9693 --concurrency 20 --duration 30 \
+        --simulator http://127.0.0.1:18443
+"""
+import argparse
+import asyncio
+import json
+import math
+import time
+from collections import Counter
+from typing import Dict, List, Any, Optional
+
+import aiohttp
+
+DEFAULT_PATHS = ['/metrics', '/prometheus-sd-targets']
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """
+    The nearest rank percentile
+    :param sorted_values: the values in ascending order
+    :param fraction: the percentile as a fraction, e.g. 0.99
+    :return:
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class LoadDriver:
+    """
+    Request the paths of the server from concurrent workers for a duration. Each worker request the paths in
+    turn.
+    """
+
+    def __init__(self, url: str, paths: List[str], concurrency: int, duration: float,
+                 auth: Optional[aiohttp.BasicAuth] = None, headers: Optional[Dict[str, str]] = None):
+        self.url = url.rstrip('/')
+        self.paths = paths
+        self.concurrency = concurrency
+        self.duration = duration
+        self.auth = auth
+        self.headers = headers or {}
+        self.latencies: Dict[str, List[float]] = {path: [] for path in paths}
+        self.statuses: Dict[str, Counter] = {path: Counter() for path in paths}
+        self.errors: Counter = Counter()
+
+    async def run(self, simulator: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Run the load
+        :param simulator: the url of the FortiManager simulator to get the number of calls from
+        :return: the report
+        """
+        async with aiohttp.ClientSession(auth=self.auth, headers=self.headers,
+                                         connector=aiohttp.TCPConnector(limit=self.concurrency)) as client:
+            calls_before = await self._simulator_calls(client, simulator)
+            start = time.perf_counter()
+            deadline = start + self.duration
+            await asyncio.gather(*[self._worker(client, worker, deadline) for worker in range(self.concurrency)])
+            elapsed = time.perf_counter() - start
+            calls_after = await self._simulator_calls(client, simulator)
+        return self.report(elapsed, calls_before, calls_after)
+
+    async def _worker(self, client: aiohttp.ClientSession, worker: int, deadline: float):
+        request = worker
+        while time.perf_counter() < deadline:
+            path = self.paths[request % len(self.paths)]
+            request += 1
+            start = time.perf_counter()
+            try:
+                async with client.get(self.url + path) as response:
+                    await response.read()
+                    self.statuses[path][response.status] += 1
+            except aiohttp.ClientError as err:
+                self.errors[type(err).__name__] += 1
+                continue
+            self.latencies[path].append(time.perf_counter() - start)
+
+    @staticmethod
+    async def _simulator_calls(client: aiohttp.ClientSession, simulator: Optional[str]) -> Optional[Counter]:
+        if not simulator:
+            return None
+        async with client.get(simulator.rstrip('/') + '/stats') as response:
+            return Counter((await response.json())['calls'])
+
+    def report(self, elapsed: float, calls_before: Optional[Counter], calls_after: Optional[Counter]) \
+            -> Dict[str, Any]:
+        result: Dict[str, Any] = {'duration': elapsed, 'concurrency': self.concurrency, 'paths': {},
+                                  'errors': dict(self.errors)}
+        for path, latencies in self.latencies.items():
+            latencies.sort()
+            result['paths'][path] = {'requests': len(latencies),
+                                     'throughput': len(latencies) / elapsed if elapsed else 0.0,
+                                     'p50': percentile(latencies, 0.5), 'p99': percentile(latencies, 0.99),
+                                     'max': latencies[-1] if latencies else 0.0,
+                                     'status': {str(code): count for code, count in self.statuses[path].items()}}
+        if calls_before is not None and calls_after is not None:
+            calls_after.subtract(calls_before)
+            result['fmg_calls'] = {call: count for call, count in calls_after.items() if count}
+        return result
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    lines = [f"duration={report['duration']:.1f}s concurrency={report['concurrency']}"]
+    for path, path_report in report['paths'].items():
+        status = ','.join(f"{code}:{count}" for code, count in sorted(path_report['status'].items()))
+        lines.append(f"path={path} requests={path_report['requests']} "
+                     f"throughput={path_report['throughput']:.1f}/s p50={path_report['p50'] * 1000:.1f}ms "
+                     f"p99={path_report['p99'] * 1000:.1f}ms max={path_report['max'] * 1000:.1f}ms "
+                     f"status={status}")
+    for error, count in report['errors'].items():
+        lines.append(f"error={error} count={count}")
+    for call, count in sorted(report.get('fmg_calls', {}).items()):
+        lines.append(f"fmg_call=\"{call}\" count={count}")
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load driver for the fmg_discovery server')
+    parser.add_argument('--url', default='http://localhost:9693', help='The url of the server')
+    parser.add_argument('--path', action='append', dest='paths',
+                        help=f"A path to request, can be repeated, default {' and '.join(DEFAULT_PATHS)}")
+    parser.add_argument('--concurrency', type=int, default=10, help='Number of concurrent requests, default 10')
+    parser.add_argument('--duration', type=float, default=10, help='Number of seconds to run, default 10')
+    parser.add_argument('--username', help='Basic auth username')
+    parser.add_argument('--password', help='Basic auth password')
+    parser.add_argument('--accept-encoding', dest='accept_encoding', default='gzip',
+                        help='The Accept-Encoding header, default gzip')
+    parser.add_argument('--simulator', help='The url of the FortiManager simulator, to report the number of calls')
+    parser.add_argument('--json', action='store_true', help='Print the report as json')
+    args = parser.parse_args()
+
+    driver = LoadDriver(args.url, args.paths or DEFAULT_PATHS, args.concurrency, args.duration,
+                        aiohttp.BasicAuth(args.username, args.password or '') if args.username else None,
+                        {'Accept-Encoding': args.accept_encoding})
+    load_report = asyncio.run(driver.run(args.simulator))
+    print(json.dumps(load_report, indent=2) if args.json else format_report(load_report))
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2023  Anders Håål
+
+    This file is part of fortigate-exporter-discovery.
+
+    fortigate-exporter-discovery is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    fortigate-exporter-discovery is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fortigate-exporter-discovery.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import cProfile
+import io
+import marshal
+import pstats
+import sys
+import threading
+from collections import Counter
+from typing import Callable, Awaitable, Any, Optional
+
+# Sampling stops after this number of seconds even if the profiled coroutine is not done
+MAX_SAMPLE_SECONDS = 300
+
+
+class StackSampler:
+    """
+    Sample the stack of a thread at a fixed interval from a separate thread. The samples are counted per stack,
+    and returned in the collapsed stack format, one line per stack with the frames from the root separated by ;
+    and the number of samples, that can be used to create flame graphs.
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        elapsed = 0.0
+        while not self._stop.wait(self.interval) and elapsed < MAX_SAMPLE_SECONDS:
+            elapsed += self.interval
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None:
+                frames.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            if frames:
+                self.stacks[';'.join(reversed(frames))] += 1
+
+    def collapsed(self) -> str:
+        return ''.join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+
+async def sample(coroutine_function: Callable[[], Awaitable[Any]], interval: float = 0.005) -> str:
+    """
+    Sample the stack of the event loop thread while the coroutine run
+    :param coroutine_function: the coroutine function to run while sampling, e.g. a sleep for a time-boxed sample
+    :param interval: the sample interval in seconds
+    :return: the collapsed stacks
+    """
+    sampler = StackSampler(threading.get_ident(), interval)
+    sampler.start()
+    try:
+        await coroutine_function()
+    finally:
+        sampler.stop()
+    return sampler.collapsed()
+
+
+async def profile(coroutine_function: Callable[[], Awaitable[Any]]) -> cProfile.Profile:
+    """
+    Run a deterministic profile of the event loop thread while the coroutine run. Everything that run on the
+    event loop in the meantime is included, not only the coroutine.
+    :param coroutine_function: the coroutine function to run while profiling
+    :return: the profile
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await coroutine_function()
+    finally:
+        profiler.disable()
+    return profiler
+
+
+def pstats_dump(profiler: cProfile.Profile) -> bytes:
+    """
+    The profile in the same format as cProfile dump_stats, that can be loaded with pstats.Stats
+    :param profiler:
+    :return:
+    """
+    profiler.create_stats()
+    return marshal.dumps(profiler.stats)
+
+
+def pstats_text(profiler: cProfile.Profile, sort: str = 'cumulative', limit: int = 100) -> str:
+    """
+    The profile as text, sorted and limited to the top functions
+    :param profiler:
+    :param sort: the pstats sort key
+    :param limit: max number of functions
+    :return:
+    """
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats(sort).print_stats(limit)
+    return stream.getvalue()
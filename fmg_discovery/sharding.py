@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2023  Anders Håål
+
+    This file is part of fortigate-exporter-discovery.
+
+    fortigate-exporter-discovery is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    fortigate-exporter-discovery is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fortigate-exporter-discovery.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import hashlib
+from array import array
+from typing import List, Sequence
+
+from fmg_discovery.fw import Fortigate
+
+SHARD_BY_NAME = 'name'
+SHARD_BY_SN = 'sn'
+SHARD_BY = (SHARD_BY_NAME, SHARD_BY_SN)
+
+
+def shard_hash(value: str) -> int:
+    """
+    The hash used by the Prometheus hashmod relabel action, the last 8 bytes of the md5 sum as a big endian integer
+    :param value:
+    :return:
+    """
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[8:], 'big')
+
+
+def hashmod(value: str, modulus: int) -> int:
+    """
+    The same as the Prometheus relabel action hashmod
+    :param value: the source label value
+    :param modulus:
+    :return:
+    """
+    return shard_hash(value) % modulus
+
+
+def shard_hashes(fws: List[Fortigate], shard_by: str = SHARD_BY_NAME) -> Sequence[int]:
+    """
+    The shard hash of each Fortigate, in the same order as the Fortigates
+    :param fws:
+    :param shard_by: the Fortigate attribute to hash, name or sn
+    :return:
+    """
+    if shard_by not in SHARD_BY:
+        raise ValueError(f"Can not shard by {shard_by}, must be one of {', '.join(SHARD_BY)}")
+    return array('Q', (shard_hash(getattr(fw, shard_by)) for fw in fws))
+
+
+def partition(fws: List[Fortigate], hashes: Sequence[int], shards: int) -> List[List[Fortigate]]:
+    """
+    Partition the Fortigates in shards
+    :param fws:
+    :param hashes: the shard hashes of the Fortigates from shard_hashes
+    :param shards: the number of shards
+    :return: a list of Fortigates per shard
+    """
+    partitions: List[List[Fortigate]] = [[] for _ in range(shards)]
+    for fw, fw_hash in zip(fws, hashes):
+        partitions[fw_hash % shards].append(fw)
+    return partitions
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2023  Anders Håål
+
+    This file is part of fortigate-exporter-discovery.
+
+    fortigate-exporter-discovery is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    fortigate-exporter-discovery is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fortigate-exporter-discovery.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from email.utils import formatdate
+from typing import Dict, List, Tuple, Callable, Awaitable, Optional, Any, Iterable, Set
+
+from fmg_discovery.compression import compress_chunks
+from fmg_discovery.fw import Fortigate, META_LABEL_PREFIX, meta_label_name
+
+# The Fortigate attributes a snapshot can be filtered on
+FILTER_ATTRIBUTES = ('adom', 'platform', 'conn_status')
+# Max number of filtered snapshots kept per snapshot
+MAX_FILTERED = 64
+# Max number of partitions, one per number of shards, kept per snapshot
+MAX_PARTITIONS = 8
+
+# A normalized filter query, a sorted tuple of attribute or label name and the sorted values to match
+Query = Tuple[Tuple[str, Tuple[str, ...]], ...]
+
+
+class Snapshot:
+    """
+    An immutable view of the cached Fortigates. Response bodies are rendered once per snapshot and reused by all
+    requests until a new snapshot is created. A body is kept as the list of chunks it was rendered as, e.g. per
+    adom, and never joined, so it can be streamed without copying.
+    """
+
+    def __init__(self, generation: int, fws: Dict[str, List[Fortigate]], fingerprints: Dict[str, str] = None,
+                 created: Optional[float] = None, partition: str = ''):
+        self.generation: int = generation
+        self.fws: Dict[str, List[Fortigate]] = fws
+        # The fingerprint of the Fortigates per adom, adoms without a fingerprint are never cached as fragments
+        self.fingerprints: Dict[str, str] = fingerprints or {}
+        self.created: float = time.time() if created is None else created
+        # The name of the shard if the snapshot is a shard of another snapshot, e.g. 1-4
+        self.partition: str = partition
+        # The rendered bodies, kept as futures so concurrent requests share the same rendering
+        self._rendered: Dict[Tuple[str, Optional[str]], 'asyncio.Future[Tuple[List[bytes], str]]'] = {}
+        self._shards: 'OrderedDict[int, List[Snapshot]]' = OrderedDict()
+        self._index: Optional[SnapshotIndex] = None
+        self._filtered: 'OrderedDict[Query, Snapshot]' = OrderedDict()
+
+    @property
+    def last_modified(self) -> str:
+        """
+        The creation time of the snapshot formatted for the Last-Modified header
+        :return:
+        """
+        return formatdate(self.created, usegmt=True)
+
+    def shard(self, shard: int, shards: int,
+              partition_function: Callable[[str, Optional[str], List[Fortigate], int], List[List[Fortigate]]]) \
+            -> 'Snapshot':
+        """
+        Get the snapshot with the Fortigates of a shard. All shards are partitioned the first time a shard is
+        requested for the number of shards, after that the same shard snapshot is returned. The partitions of the
+        least recently used number of shards are dropped when there are more than MAX_PARTITIONS.
+        :param shard: the shard, 0 to shards - 1
+        :param shards: the number of shards
+        :param partition_function: the function that partition the Fortigates of an adom, called with adom name,
+        fingerprint, Fortigates and number of shards
+        :return:
+        """
+        shard_snapshots = self._shards.get(shards)
+        if shard_snapshots is None:
+            partitions: List[Dict[str, List[Fortigate]]] = [{} for _ in range(shards)]
+            for adom_name, adom_fws in self.fws.items():
+                adom_partitions = partition_function(adom_name, self.fingerprints.get(adom_name), adom_fws, shards)
+                for index, shard_fws in enumerate(adom_partitions):
+                    partitions[index][adom_name] = shard_fws
+            shard_snapshots = [Snapshot(self.generation, shard_fws, self.fingerprints, self.created,
+                                        f"{index}-{shards}")
+                               for index, shard_fws in enumerate(partitions)]
+            self._shards[shards] = shard_snapshots
+            if len(self._shards) > MAX_PARTITIONS:
+                self._shards.popitem(last=False)
+        else:
+            self._shards.move_to_end(shards)
+        return shard_snapshots[shard]
+
+    def filter(self, query: Query) -> 'Snapshot':
+        """
+        Get the snapshot with the Fortigates matching the query. The index is created the first time the snapshot
+        is filtered, and the filtered snapshot is cached per query, so it is only rendered once.
+        :param query: the normalized query from normalize_query
+        :return:
+        """
+        if not query:
+            return self
+        filtered = self._filtered.get(query)
+        if filtered is None:
+            if self._index is None:
+                self._index = SnapshotIndex(self.fws)
+            # The fragments of the adoms are not valid for a filtered snapshot, so no fingerprints
+            filtered = Snapshot(self.generation, self._index.select(query), None, self.created)
+            self._filtered[query] = filtered
+            if len(self._filtered) > MAX_FILTERED:
+                self._filtered.popitem(last=False)
+        else:
+            self._filtered.move_to_end(query)
+        return filtered
+
+    async def render(self, name: str, render_function: Callable[['Snapshot'], Awaitable[List[bytes]]],
+                     encoding: Optional[str] = None) -> Tuple[List[bytes], str]:
+        """
+        Get the rendered body with the name, the body is only rendered, and compressed, the first time. Requests
+        that arrive while the body is rendered wait for the same rendering.
+        :param name: the name of the rendered body
+        :param render_function: the coroutine function that render the body chunks from the snapshot
+        :param encoding: the content encoding of the body, None for not compressed
+        :return: the body chunks and its strong etag
+        """
+        key = (name, encoding)
+        rendered = self._rendered.get(key)
+        if rendered is None:
+            rendered = asyncio.ensure_future(self._render(name, render_function, encoding))
+            self._rendered[key] = rendered
+            rendered.add_done_callback(lambda future: self._forget_failed(key, future))
+        # Shield so a cancelled request do not cancel the rendering for the other requests
+        return await asyncio.shield(rendered)
+
+    async def _render(self, name: str, render_function: Callable[['Snapshot'], Awaitable[List[bytes]]],
+                      encoding: Optional[str]) -> Tuple[List[bytes], str]:
+        if encoding is None:
+            chunks = await render_function(self)
+            return chunks, etag(chunks)
+        chunks, _ = await self.render(name, render_function)
+        # Compress in a thread so a large body do not block the event loop
+        compressed = await asyncio.get_running_loop().run_in_executor(None, compress_chunks, chunks, encoding)
+        return compressed, etag(chunks, encoding)
+
+    def _forget_failed(self, key: Tuple[str, Optional[str]], future: 'asyncio.Future'):
+        # A failed rendering is done again by the next request
+        if future.cancelled() or future.exception() is not None:
+            self._rendered.pop(key, None)
+
+
+class SnapshotIndex:
+    """
+    Inverted indexes of the Fortigates in a snapshot. Each index map an attribute value, or a label value, to the
+    positions of the Fortigates with that value. All the labels of the discovery response are indexed, not only the
+    adom labels.
+    """
+
+    def __init__(self, fws: Dict[str, List[Fortigate]]):
+        self.adom_names: List[str] = list(fws.keys())
+        self.fws: List[Tuple[str, Fortigate]] = []
+        self.indexes: Dict[str, Dict[str, List[int]]] = {attribute: {} for attribute in FILTER_ATTRIBUTES}
+        attribute_indexes = [(attribute, self.indexes[attribute]) for attribute in FILTER_ATTRIBUTES]
+        for adom_name, adom_fws in fws.items():
+            for fw in adom_fws:
+                position = len(self.fws)
+                self.fws.append((adom_name, fw))
+                for attribute, index in attribute_indexes:
+                    index.setdefault(getattr(fw, attribute), []).append(position)
+                for label_name, label_value in fw.as_prometheus_file_sd_entry()['labels'].items():
+                    self.indexes.setdefault(label_name, {}).setdefault(label_value, []).append(position)
+
+    def select(self, query: Query) -> Dict[str, List[Fortigate]]:
+        """
+        Select the Fortigates matching all the query terms, a term match if the value is any of the term values
+        :param query:
+        :return: the matching Fortigates per adom, in the same order as in the snapshot
+        """
+        matches: List[Set[int]] = []
+        for name, values in query:
+            index = self.indexes.get(name, {})
+            matches.append(set().union(*(index.get(value, ()) for value in values)))
+        # Intersect starting with the smallest
+        matches.sort(key=len)
+        selected = matches[0].intersection(*matches[1:]) if matches else set(range(len(self.fws)))
+
+        fws: Dict[str, List[Fortigate]] = {adom_name: [] for adom_name in self.adom_names}
+        for position in sorted(selected):
+            adom_name, fw = self.fws[position]
+            fws[adom_name].append(fw)
+        return fws
+
+
+def normalize_query(attributes: Dict[str, Optional[List[str]]], labels: Optional[List[str]]) -> Query:
+    """
+    Create a normalized query, so the same query always has the same key independent of the order of the terms
+    :param attributes: the values to match per attribute in FILTER_ATTRIBUTES
+    :param labels: label matchers as name=value, the name with or without the __meta_fortigate_ prefix
+    :return:
+    :raise ValueError: if a attribute or label matcher is not valid
+    """
+    terms: Dict[str, Set[str]] = {}
+    for attribute, values in attributes.items():
+        if attribute not in FILTER_ATTRIBUTES:
+            raise ValueError(f"Can not filter on {attribute}")
+        if values:
+            terms.setdefault(attribute, set()).update(values)
+    for label in labels or []:
+        name, separator, value = label.partition('=')
+        if not separator or not name:
+            raise ValueError(f"Label matcher {label} must be name=value")
+        if not name.startswith(META_LABEL_PREFIX):
+            name = meta_label_name(name)
+        terms.setdefault(name, set()).add(value)
+    return tuple(sorted((name, tuple(sorted(values))) for name, values in terms.items()))
+
+
+class FragmentCache:
+    """
+    Cache the rendered fragment of each adom by its fingerprint, so only adoms that changed are rendered again
+    when a new snapshot is created. If max_names is set, only the fragments of the most recently used names are
+    kept.
+    """
+
+    def __init__(self, max_names: Optional[int] = None):
+        self._fragments: 'OrderedDict[str, Dict[str, Tuple[str, Any]]]' = OrderedDict()
+        self._max_names: Optional[int] = max_names
+
+    def get(self, name: str, adom_name: str, fingerprint: Optional[str],
+            render_function: Callable[[], Any]) -> Any:
+        """
+        Get the rendered fragment of the adom
+        :param name: the name of the rendered fragment
+        :param adom_name:
+        :param fingerprint: the fingerprint of the adom Fortigates, if None the fragment is not cached
+        :param render_function: the function that render the fragment
+        :return:
+        """
+        if fingerprint is None:
+            return render_function()
+        fragments = self._fragments.get(name)
+        if fragments is None:
+            fragments = {}
+            self._fragments[name] = fragments
+            if self._max_names is not None and len(self._fragments) > self._max_names:
+                self._fragments.popitem(last=False)
+        else:
+            self._fragments.move_to_end(name)
+        cached = fragments.get(adom_name)
+        if cached is None or cached[0] != fingerprint:
+            cached = (fingerprint, render_function())
+            fragments[adom_name] = cached
+        return cached[1]
+
+    def __len__(self) -> int:
+        return sum(len(fragments) for fragments in self._fragments.values())
+
+
+def etag(chunks: Iterable[bytes], encoding: Optional[str] = None) -> str:
+    body_hash = hashlib.sha1()
+    for chunk in chunks:
+        body_hash.update(chunk)
+    # Each content encoding is a different representation and must have its own strong etag
+    if encoding:
+        return f"\"{body_hash.hexdigest()}-{encoding}\""
+    return f"\"{body_hash.hexdigest()}\""
+
+
+def etag_match(if_none_match: Optional[str], current_etag: str) -> bool:
+    """
+    Check if the If-None-Match header match the etag
+    :param if_none_match: the header value, a comma separated list of etags or *
+    :param current_etag:
+    :return:
+    """
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(','):
+        # If-None-Match use the weak comparison
+        tag = tag.strip().replace('W/', '', 1)
+        if tag == '*' or tag == current_etag:
+            return True
+    return False
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2023  Anders Håål
+
+    This file is part of fortigate-exporter-discovery.
+
+    fortigate-exporter-discovery is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    fortigate-exporter-discovery is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fortigate-exporter-discovery.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import tempfile
+import time
+from types import MappingProxyType
+from typing import Dict, List, Tuple, Optional
+
+from fmg_discovery import json_codec
+from fmg_discovery.fw import Fortigate, EMPTY_LABELS
+
+SNAPSHOT_VERSION = 1
+
+# The Fortigate fields stored in the snapshot file, in order. The adom labels are stored once per adom.
+# New fields are added last, so a snapshot saved by an older version can still be loaded.
+FIELDS = ('name', 'ip', 'token', 'port', 'adom', 'latitude', 'longitude', 'platform', 'profile', 'conf_status',
+          'conn_mode', 'conn_status', 'desc', 'ha_group_id', 'ha_group_name', 'ha_mode', 'ha_slave', 'fmg',
+          'sn')
+
+
+def save_snapshot(path: str, adoms: Dict[str, Tuple[Optional[str], List[Fortigate]]],
+                  updated: Optional[Dict[str, float]] = None):
+    """
+    Save the Fortigates per adom as compact json. Each Fortigate is stored as a list of the FIELDS values.
+    The file is written to a temporary file that is atomically moved in place.
+    :param path: the snapshot file
+    :param adoms: the fingerprint and Fortigates per adom
+    :param updated: the time the Fortigates of each adom were last fetched successfully, default now
+    :return:
+    """
+    created = time.time()
+    updated = updated or {}
+    data = {'version': SNAPSHOT_VERSION, 'created': created, 'adoms': {}}
+    for adom_name, (fingerprint, fws) in adoms.items():
+        data['adoms'][adom_name] = {'fingerprint': fingerprint, 'updated': updated.get(adom_name, created),
+                                    'labels': dict(fws[0].labels) if fws else {},
+                                    'fortigates': [[getattr(fw, field) for field in FIELDS] for fw in fws]}
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(json_codec.dumps(data))
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_snapshot(path: str) -> Tuple[Dict[str, float], Dict[str, Tuple[Optional[str], List[Fortigate]]]]:
+    """
+    Load the Fortigates per adom saved by save_snapshot
+    :param path: the snapshot file
+    :return: the time the Fortigates of each adom were last fetched successfully, and the fingerprint and
+    Fortigates per adom, empty if there is no snapshot file
+    """
+    if not os.path.exists(path):
+        return {}, {}
+    with open(path, 'rb') as snapshot_file:
+        data = json_codec.loads(snapshot_file.read())
+    if data.get('version') != SNAPSHOT_VERSION:
+        return {}, {}
+
+    updated: Dict[str, float] = {}
+    adoms: Dict[str, Tuple[Optional[str], List[Fortigate]]] = {}
+    for adom_name, adom in data['adoms'].items():
+        labels = MappingProxyType(adom['labels']) if adom['labels'] else EMPTY_LABELS
+        updated[adom_name] = float(adom.get('updated', data.get('created', 0)))
+        adoms[adom_name] = (adom['fingerprint'],
+                            [Fortigate(labels=labels, **dict(zip(FIELDS, values))) for values in adom['fortigates']])
+    return updated, adoms
@@ -26,7 +26,7 @@ setup(
         "branch_formatter": None
     },
     setup_requires=['setuptools-git-versioning'],
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     author='thenodon',
     author_email='aha@ingby.com',
     url='https://github.com/thenodon/fortigate-exporter-discovery',
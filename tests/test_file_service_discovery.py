@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2023  Anders Håål
+
+    This file is part of fortigate-exporter-discovery.
+
+    fortigate-exporter-discovery is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    fortigate-exporter-discovery is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fortigate-exporter-discovery.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import os
+import stat
+
+import yaml
+
+from fmg_discovery.file_service_discovery import FileServiceDiscoveryWriter, ShardedFileServiceDiscoveryWriter, \
+    MANIFEST_FILE
+from fmg_discovery.fw import Fortigate
+
+
+def fws(adom_name, count):
+    return [Fortigate(f"fw-{adom_name}-{i}", f"10.0.0.{i}", adom=adom_name) for i in range(count)]
+
+
+def read(path):
+    with open(path, 'r') as file:
+        return yaml.safe_load(file)
+
+
+def test_unchanged_content_is_not_rewritten(tmp_path):
+    writer = FileServiceDiscoveryWriter(str(tmp_path))
+    assert writer.write({'A': fws('A', 2)}, ['A'])['changed'] == 1
+    mtime = os.stat(tmp_path / 'A.yaml').st_mtime_ns
+    os.utime(tmp_path / 'A.yaml', ns=(mtime - 10 ** 9, mtime - 10 ** 9))
+
+    # A new writer has no content hashes and compare with the file on disk
+    for current in (writer, FileServiceDiscoveryWriter(str(tmp_path))):
+        result = current.write({'A': fws('A', 2)}, ['A'])
+        assert result == {'changed': 0, 'unchanged': 1, 'removed': 0}
+        assert os.stat(tmp_path / 'A.yaml').st_mtime_ns == mtime - 10 ** 9
+
+
+def test_adom_without_devices_empties_its_file(tmp_path):
+    writer = FileServiceDiscoveryWriter(str(tmp_path))
+    writer.write({'A': fws('A', 2)}, ['A'])
+    assert len(read(tmp_path / 'A.yaml')) == 2
+
+    assert writer.write({'A': []}, ['A'])['changed'] == 1
+    assert read(tmp_path / 'A.yaml') == []
+
+
+def test_failed_adom_is_left_alone(tmp_path):
+    writer = FileServiceDiscoveryWriter(str(tmp_path))
+    writer.write({'A': fws('A', 1), 'B': fws('B', 2)}, ['A', 'B'])
+
+    result = writer.write({'A': fws('A', 3)}, ['A', 'B'])
+    assert result == {'changed': 1, 'unchanged': 0, 'removed': 0}
+    assert len(read(tmp_path / 'A.yaml')) == 3
+    assert len(read(tmp_path / 'B.yaml')) == 2
+
+
+def test_only_written_files_are_removed(tmp_path):
+    (tmp_path / 'other.yaml').write_text('[]')
+    writer = FileServiceDiscoveryWriter(str(tmp_path))
+    writer.write({'A': fws('A', 1), 'B': fws('B', 1)}, ['A', 'B'])
+
+    # A new writer remove the files of earlier runs from the manifest
+    result = FileServiceDiscoveryWriter(str(tmp_path)).write({'A': fws('A', 1)}, ['A'])
+    assert result['removed'] == 1
+    assert sorted(os.listdir(tmp_path)) == [MANIFEST_FILE, 'A.yaml', 'other.yaml']
+    assert read(tmp_path / MANIFEST_FILE) == ['A.yaml']
+
+
+def test_file_mode(tmp_path):
+    umask = os.umask(0o027)
+    try:
+        FileServiceDiscoveryWriter(str(tmp_path)).write({'A': fws('A', 1)}, ['A'])
+    finally:
+        os.umask(umask)
+    assert stat.S_IMODE(os.stat(tmp_path / 'A.yaml').st_mode) == 0o640
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+
+
+def test_sharded_writer_removes_unsharded_files(tmp_path):
+    (tmp_path / 'other.yaml').write_text('[]')
+    FileServiceDiscoveryWriter(str(tmp_path)).write({'A': fws('A', 4)}, ['A'])
+    # Written before the manifest
+    (tmp_path / 'B.yaml').write_text('[]')
+
+    writer = ShardedFileServiceDiscoveryWriter(str(tmp_path), 2)
+    result = writer.write({'A': fws('A', 4), 'B': fws('B', 4)}, ['A', 'B'])
+    assert result['removed'] == 2
+    assert sorted(name for name in os.listdir(tmp_path) if name.endswith('.yaml')) == ['other.yaml']
+    assert sum(len(read(tmp_path / f"shard-{shard}" / 'A.yaml')) for shard in range(2)) == 4
+    assert writer.write({'A': fws('A', 4), 'B': fws('B', 4)}, ['A', 'B'])['removed'] == 0
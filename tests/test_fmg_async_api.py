@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2023  Anders Håål
+
+    This file is part of fortigate-exporter-discovery.
+
+    fortigate-exporter-discovery is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    fortigate-exporter-discovery is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fortigate-exporter-discovery.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import asyncio
+
+from aiohttp import web
+
+from fmg_discovery.fmg_async_api import AsyncFMG, DEVICE_FIELDS, LOGIN_URL, LOGOUT_URL
+from fmg_discovery.fmg_simulator import FmgSimulator, device_rows, simulator_config
+
+
+async def with_simulator(rows, test, simulator=None, **fmg_options):
+    """
+    Run test(fmg, simulator) against an in-process simulator of the rows, the client is closed after the test
+    """
+    simulator = simulator or FmgSimulator(rows)
+    runner = web.AppRunner(simulator.app())
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    config = simulator_config(f"http://{host}:{port}", rows)
+    config['fmg'].update(fmg_options)
+    try:
+        async with AsyncFMG(config) as fmg:
+            await fmg._ensure_session()
+            return await test(fmg, simulator)
+    finally:
+        await runner.cleanup()
+
+
+def expected(rows, adom):
+    return [{field: row[field] for field in DEVICE_FIELDS if field in row} for row in rows[adom]]
+
+
+def test_batch_maps_results_to_adoms():
+    rows = device_rows(30, 3)
+
+    async def test(fmg, _):
+        # Not in the configured order, so a positional mix-up is detected
+        return await fmg._get_fw_devices_batch(['ADOM_002', 'ADOM_000', 'ADOM_001'])
+
+    devices = asyncio.run(with_simulator(rows, test))
+
+    assert list(devices) == ['ADOM_002', 'ADOM_000', 'ADOM_001']
+    for adom, adom_devices in devices.items():
+        assert adom_devices == expected(rows, adom)
+
+
+def test_batch_failing_adom_leave_others_intact():
+    rows = device_rows(20, 2)
+
+    async def test(fmg, _):
+        return await fmg._get_fw_devices_batch(['ADOM_000', 'MISSING', 'ADOM_001'])
+
+    devices = asyncio.run(with_simulator(rows, test))
+
+    assert devices['MISSING'] is None
+    assert devices['ADOM_000'] == expected(rows, 'ADOM_000')
+    assert devices['ADOM_001'] == expected(rows, 'ADOM_001')
+
+
+def test_batch_page_from_offset():
+    rows = device_rows(30, 1)
+
+    async def test(fmg, _):
+        return await fmg._get_fw_devices_batch(['ADOM_000'], offset=10)
+
+    devices = asyncio.run(with_simulator(rows, test, page_size=8))
+
+    assert devices['ADOM_000'] == expected(rows, 'ADOM_000')[10:18]
+
+
+def test_get_fmg_devices_keep_other_adoms_on_failure():
+    rows = device_rows(30, 3)
+
+    async def test(fmg, _):
+        fmg.fmg_configuration['fmg']['adoms'].insert(1, {'name': 'MISSING'})
+        return await fmg.get_fmg_devices()
+
+    fws = asyncio.run(with_simulator(rows, test, batch_size=2))
+
+    assert list(fws) == ['ADOM_000', 'ADOM_001', 'ADOM_002']
+    for adom, adom_fws in fws.items():
+        assert [fw.name for fw in adom_fws] == [row['name'] for row in rows[adom]]
+
+
+def test_expired_session_is_renewed():
+    rows = device_rows(30, 3)
+    simulator = FmgSimulator(rows, session_ttl=0.2)
+
+    async def test(fmg, _):
+        first_session = fmg.session
+        first = await fmg.get_fmg_devices()
+        await asyncio.sleep(0.3)
+        second = await fmg.get_fmg_devices()
+        return first_session, fmg.session, first, second
+
+    first_session, session, first, second = asyncio.run(with_simulator(rows, test, simulator))
+
+    assert simulator.calls[('exec', LOGIN_URL)] == 2
+    assert session != first_session
+    for devices in (first, second):
+        assert {adom: [fw.name for fw in fws] for adom, fws in devices.items()} == \
+               {adom: [row['name'] for row in adom_rows] for adom, adom_rows in rows.items()}
+
+
+def test_close_logout():
+    rows = device_rows(10, 1)
+    simulator = FmgSimulator(rows)
+
+    async def test(fmg, _):
+        await fmg.get_fmg_devices()
+        return fmg.session
+
+    session = asyncio.run(with_simulator(rows, test, simulator))
+
+    assert session is not None
+    assert simulator.calls[('exec', LOGOUT_URL)] == 1
+    assert simulator.sessions == {}
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2023  Anders Håål
+
+    This file is part of fortigate-exporter-discovery.
+
+    fortigate-exporter-discovery is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    fortigate-exporter-discovery is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fortigate-exporter-discovery.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import asyncio
+
+from fmg_discovery.fmg_collector import FmgCollector
+from fmg_discovery.fmg_metrics import FmgMetricColumns, generate_metrics
+from fmg_discovery.fmg_simulator import device_rows
+from fmg_discovery.fw import Fortigate, fw_factory, adom_labels
+from fmg_discovery.http_service_discovery import generate_latest
+
+
+def fortigates():
+    fws = {}
+    for adom_name, rows in device_rows(500, adoms=4).items():
+        adom = {'name': adom_name, 'labels': {'customer': adom_name.lower()}, 'fortigate': {'token': 'token'}}
+        labels = adom_labels(adom)
+        fws[adom_name] = [fw_factory(adom, row, labels) for row in rows]
+    # Label values that must be escaped
+    fws['ESCAPE'] = [Fortigate('fw-"quoted"', '10.0.0.1', adom='ESCAPE', platform='back\\slash\nline')]
+    fws['EMPTY'] = []
+    return fws
+
+
+def test_columnar_metrics_is_generate_latest():
+    fws = fortigates()
+    expected = generate_latest(asyncio.run(FmgCollector(fws).collect()))
+
+    assert generate_metrics([FmgMetricColumns(adom_fws) for adom_fws in fws.values()]) == expected
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2023  Anders Håål
+
+    This file is part of fortigate-exporter-discovery.
+
+    fortigate-exporter-discovery is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    fortigate-exporter-discovery is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fortigate-exporter-discovery.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import asyncio
+import time
+
+import pytest
+import yaml
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+from fmg_discovery import http_service_discovery as hsd
+from fmg_discovery.compression import supported_encodings, GZIP
+from fmg_discovery.environments import FMG_DISCOVERY_CONFIG, FMG_DISCOVERY_CACHE_TTL, \
+    FMG_DISCOVERY_CACHE_NEGATIVE_TTL, FMG_DISCOVERY_CACHE_MAX_STALENESS, FMG_DISCOVERY_CACHE_JITTER, \
+    FMG_DISCOVERY_SNAPSHOT_FILE
+from fmg_discovery.exceptions import FmgException
+from fmg_discovery.fw import Fortigate
+from fmg_discovery.snapshot_file import save_snapshot, load_snapshot
+
+
+class Clock:
+    """
+    A settable replacement of the time module
+    """
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class FakeFMG:
+    """
+    Return the Fortigates of the adoms that are not failing, after the delay
+    """
+
+    def __init__(self, fws):
+        self.fws = fws
+        self.failing = set()
+        self.calls = []
+        self.fingerprints = {}
+        self.delay = 0
+
+    async def get_fmg_devices(self, adoms):
+        names = [adom['name'] for adom in adoms]
+        self.calls.append(names)
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        result = {name: self.fws[name] for name in names if name not in self.failing}
+        if not result:
+            raise FmgException(message="All FortiManagers failed")
+        self.fingerprints.update({name: f"{name}-{id(fws)}" for name, fws in result.items()})
+        return result
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    config = {'fmg': {'host': 'https://fmg.test', 'username': 'u', 'password': 'p',
+                      'adoms': [{'name': 'A', 'cache_ttl': 10}, {'name': 'B'}]}}
+    (tmp_path / 'config.yml').write_text(yaml.safe_dump(config))
+    monkeypatch.setenv(FMG_DISCOVERY_CONFIG, str(tmp_path / 'config.yml'))
+    monkeypatch.setenv(FMG_DISCOVERY_CACHE_TTL, '60')
+    monkeypatch.setenv(FMG_DISCOVERY_CACHE_NEGATIVE_TTL, '5')
+    monkeypatch.setenv(FMG_DISCOVERY_CACHE_MAX_STALENESS, '600')
+    monkeypatch.setenv(FMG_DISCOVERY_CACHE_JITTER, '0')
+    # A new config and cache for each test
+    monkeypatch.setattr(hsd.Singleton, '_instances', {})
+    clock = Clock()
+    monkeypatch.setattr(hsd, 'time', clock)
+    fmg = FakeFMG({'A': [Fortigate('fw-a', '10.0.0.1', adom='A')], 'B': [Fortigate('fw-b', '10.0.0.2', adom='B')]})
+    monkeypatch.setattr(hsd.app.state, 'fmg', fmg, raising=False)
+    return clock, fmg
+
+
+def refresh():
+    try:
+        asyncio.run(hsd.refresh())
+    except FmgException:
+        pass
+
+
+def test_adom_ttl(server):
+    clock, _ = server
+    refresh()
+    cache = hsd.Cache()
+
+    clock.now += 9
+    assert cache.expired(['A', 'B']) == []
+    clock.now += 1
+    assert cache.expired(['A', 'B']) == ['A']
+    clock.now += 50
+    assert cache.expired(['A', 'B']) == ['A', 'B']
+
+
+def test_only_expired_adoms_are_refreshed(server):
+    clock, fmg = server
+    refresh()
+    clock.now += 10
+    refresh()
+
+    assert fmg.calls == [['A', 'B'], ['A']]
+
+
+def test_failed_refresh_keep_last_good(server):
+    clock, fmg = server
+    refresh()
+    good = hsd.Cache().get(['A', 'B'])
+
+    fmg.failing.add('A')
+    clock.now += 10
+    refresh()
+
+    snapshot = hsd.Cache().get(['A', 'B'])
+    assert snapshot.fws['A'] is good.fws['A']
+    assert hsd.Cache().failed() == ['A']
+
+
+def test_negative_ttl(server):
+    clock, fmg = server
+    refresh()
+    fmg.failing.add('A')
+    clock.now += 10
+    refresh()
+    cache = hsd.Cache()
+
+    clock.now += 4
+    assert cache.expired(['A', 'B']) == []
+    clock.now += 1
+    assert cache.expired(['A', 'B']) == ['A']
+
+    fmg.failing.clear()
+    refresh()
+    assert cache.failed() == []
+    assert cache.expired(['A', 'B']) == []
+
+
+def test_never_good_adom_is_left_out(server):
+    clock, fmg = server
+    fmg.failing.add('B')
+    refresh()
+    cache = hsd.Cache()
+
+    for _ in range(2):
+        assert list(cache.get(['A', 'B']).fws) == ['A']
+    assert cache.missing(['A', 'B']) == []
+    assert cache.ages() == {'A': 0}
+    assert cache.failed() == ['B']
+    response = TestClient(hsd.app).get('/prometheus-sd-targets')
+    assert response.status_code == 200
+    assert [target['labels']['__meta_fortigate_name'] for target in response.json()] == ['fw-a']
+
+    fmg.failing.clear()
+    clock.now += 5
+    refresh()
+    assert [fw.name for fw in cache.get(['A', 'B']).fws['B']] == ['fw-b']
+
+
+def test_unreachable_fmg_is_503(server):
+    _, fmg = server
+    fmg.failing.update(['A', 'B'])
+    client = TestClient(hsd.app)
+
+    for path in ['/prometheus-sd-targets', '/prometheus-sd-targets', '/metrics']:
+        assert client.get(path).status_code == 503
+
+
+def test_max_staleness(server):
+    clock, fmg = server
+    refresh()
+    fmg.failing.add('A')
+    client = TestClient(hsd.app)
+
+    clock.now += 599
+    refresh()
+    assert len(client.get('/prometheus-sd-targets').json()) == 2
+    clock.now += 1
+    refresh()
+    assert len(client.get('/prometheus-sd-targets').json()) == 1
+
+    fmg.failing.add('B')
+    clock.now += 600
+    refresh()
+    response = client.get('/prometheus-sd-targets')
+    assert response.status_code == 503
+    assert 'A' in response.text
+
+
+def test_warm_start_keeps_the_age_of_each_adom(server, tmp_path):
+    clock, _ = server
+    path = str(tmp_path / 'snapshot.json')
+    fws = {'A': ('a', [Fortigate('fw-a', '10.0.0.1', adom='A')]), 'B': ('b', [Fortigate('fw-b', '10.0.0.2', adom='B')])}
+    save_snapshot(path, fws, {'A': clock.now - 100, 'B': clock.now - 700})
+
+    updated, adoms = load_snapshot(path)
+    assert updated == {'A': clock.now - 100, 'B': clock.now - 700}
+    cache = hsd.Cache()
+    cache.load(adoms, updated)
+
+    assert cache.ages() == {'A': 100, 'B': 700}
+    assert cache.expired(['A', 'B']) == ['A', 'B']
+    assert list(cache.get(['A', 'B']).fws) == ['A']
+    clock.now += 500
+    with pytest.raises(FmgException) as err:
+        cache.get(['A', 'B'])
+    assert err.value.status == 503
+
+
+def test_warm_start_of_an_unchanged_result(server, tmp_path, monkeypatch):
+    clock, fmg = server
+    monkeypatch.setenv(FMG_DISCOVERY_SNAPSHOT_FILE, str(tmp_path / 'snapshot.json'))
+    for _ in range(21):
+        refresh()
+        clock.now += 60
+    assert len(set(fmg.fingerprints.values())) == 2
+
+    # Restart
+    monkeypatch.setattr(hsd.Singleton, '_instances', {})
+    fmg.failing.update(['A', 'B'])
+    hsd.warm_start()
+    assert hsd.Cache().ages() == {'A': 60, 'B': 60}
+    assert len(TestClient(hsd.app).get('/prometheus-sd-targets').json()) == 2
+
+
+def test_shard_fragments_are_bounded(server, monkeypatch):
+    monkeypatch.setattr(hsd, 'fragment_cache', hsd.FragmentCache())
+    monkeypatch.setattr(hsd, 'shard_fragment_cache', hsd.FragmentCache(max_names=hsd.MAX_PARTITIONS))
+    client = TestClient(hsd.app)
+
+    for shards in range(2, 20):
+        targets = [target for shard in range(shards)
+                   for target in client.get(f"/prometheus-sd-targets?shard={shard}&shards={shards}").json()]
+        assert sorted(target['targets'][0] for target in targets) == ['https://10.0.0.1:443', 'https://10.0.0.2:443']
+
+    # One fragment per adom and shard, for the last numbers of shards
+    assert len(hsd.shard_fragment_cache) == 2 * sum(range(20 - hsd.MAX_PARTITIONS, 20))
+    assert len(hsd.fragment_cache) == 2
+
+
+def test_concurrent_requests_share_one_refresh(server):
+    _, fmg = server
+    fmg.delay = 0.05
+    coalesced = REGISTRY.get_sample_value('fmg_discovery_cache_coalesced_total')
+
+    async def run():
+        return await asyncio.gather(*[hsd.get_snapshot() for _ in range(10)])
+
+    snapshots = asyncio.run(run())
+
+    assert fmg.calls == [['A', 'B']]
+    assert REGISTRY.get_sample_value('fmg_discovery_cache_coalesced_total') - coalesced == 9
+    assert all(snapshot is snapshots[0] for snapshot in snapshots)
+
+
+def test_etag_and_last_modified(server):
+    client = TestClient(hsd.app)
+    response = client.get('/prometheus-sd-targets')
+    assert response.status_code == 200
+    assert response.headers['last-modified'] == hsd.Cache().get(['A', 'B']).last_modified
+
+    not_modified = client.get('/prometheus-sd-targets', headers={'If-None-Match': response.headers['etag']})
+    assert not_modified.status_code == 304
+    assert not_modified.content == b''
+    assert client.get('/prometheus-sd-targets', headers={'If-None-Match': '"other"'}).status_code == 200
+
+
+def test_content_encoding(server):
+    client = TestClient(hsd.app)
+    identity = client.get('/metrics', headers={'Accept-Encoding': 'identity'})
+    assert 'content-encoding' not in identity.headers
+
+    etags = {identity.headers['etag']}
+    for encoding in supported_encodings():
+        response = client.get('/metrics', headers={'Accept-Encoding': encoding})
+        assert response.headers['content-encoding'] == encoding
+        assert response.headers['vary'] == 'Accept-Encoding'
+        if encoding == GZIP:
+            # The client decode the body
+            assert response.content == identity.content
+        etags.add(response.headers['etag'])
+    assert len(etags) == len(supported_encodings()) + 1
+
+
+def test_shard_validation(server):
+    client = TestClient(hsd.app)
+    for query in ['shard=0', 'shards=2', 'shard=2&shards=2', 'shard=-1&shards=2',
+                  f"shard=0&shards={hsd.MAX_SHARDS + 1}"]:
+        assert client.get(f"/prometheus-sd-targets?{query}").status_code == 400
+    assert client.get('/prometheus-sd-targets?shard=1&shards=2').status_code == 200
+
+
+def test_filter_is_cached(server, monkeypatch):
+    renders = []
+    render_discovery = hsd.render_discovery
+
+    async def counting_render(snapshot):
+        renders.append(snapshot)
+        return await render_discovery(snapshot)
+
+    monkeypatch.setattr(hsd, 'render_discovery', counting_render)
+    client = TestClient(hsd.app)
+    responses = [client.get('/prometheus-sd-targets?adom=B&label=name=fw-b') for _ in range(2)]
+
+    assert [response.json()[0]['labels']['__meta_fortigate_name'] for response in responses] == ['fw-b', 'fw-b']
+    assert responses[0].headers['etag'] == responses[1].headers['etag']
+    assert len(renders) == 1
+    assert client.get('/prometheus-sd-targets?label=name').status_code == 400
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2023  Anders Håål
+
+    This file is part of fortigate-exporter-discovery.
+
+    fortigate-exporter-discovery is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    fortigate-exporter-discovery is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fortigate-exporter-discovery.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+from fmg_discovery.fw import Fortigate
+from fmg_discovery.sharding import hashmod, shard_hashes, partition, SHARD_BY_SN
+from fmg_discovery.snapshot import Snapshot, MAX_PARTITIONS
+
+
+def test_hashmod_is_prometheus_hashmod():
+    # The value of the hashmod test in Prometheus model/relabel/relabel_test.go
+    assert hashmod('baz', 1000) == 976
+    # The last 8 bytes of md5('baz') as a big endian integer
+    assert hashmod('baz', 2 ** 64) == 0xe44cf984c85f6e88
+    assert hashmod('', 2 ** 64) == 0xe9800998ecf8427e
+
+
+def test_partition_is_hashmod():
+    fws = [Fortigate(f"fw-{i}", f"10.0.0.{i}", sn=f"FGT{i:04}") for i in range(100)]
+    for shard, shard_fws in enumerate(partition(fws, shard_hashes(fws, SHARD_BY_SN), 3)):
+        assert shard_fws
+        assert all(hashmod(fw.sn, 3) == shard for fw in shard_fws)
+
+
+def test_snapshot_partitions_are_bounded():
+    calls = []
+
+    def partition_function(adom_name, fingerprint, fws, shards):
+        calls.append(shards)
+        return partition(fws, shard_hashes(fws), shards)
+
+    snapshot = Snapshot(1, {'A': [Fortigate(f"fw-{i}", f"10.0.0.{i}") for i in range(10)]})
+    first = snapshot.shard(0, 2, partition_function)
+    for shards in range(3, 3 + MAX_PARTITIONS - 1):
+        snapshot.shard(0, shards, partition_function)
+    assert snapshot.shard(0, 2, partition_function) is first
+    assert calls.count(2) == 1
+
+    snapshot.shard(0, 3 + MAX_PARTITIONS, partition_function)
+    assert snapshot.shard(0, 2, partition_function) is first
+    # 3 was the least recently used
+    snapshot.shard(0, 3, partition_function)
+    assert calls.count(3) == 2
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+    Copyright (C) 2023  Anders Håål
+
+    This file is part of fortigate-exporter-discovery.
+
+    fortigate-exporter-discovery is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    fortigate-exporter-discovery is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with fortigate-exporter-discovery.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import asyncio
+import gzip
+
+import pytest
+
+from fmg_discovery import snapshot as snapshot_module
+from fmg_discovery.fw import Fortigate
+from fmg_discovery.snapshot import Snapshot, normalize_query
+
+
+def test_concurrent_renders_are_done_once(monkeypatch):
+    renders = []
+    compressions = []
+    compress_chunks = snapshot_module.compress_chunks
+
+    def counting_compress(chunks, encoding):
+        compressions.append(encoding)
+        return compress_chunks(chunks, encoding)
+
+    async def render_function(snapshot):
+        renders.append(snapshot)
+        await asyncio.sleep(0.01)
+        return [fw.name.encode('utf-8') for fw in snapshot.fws['A']]
+
+    async def run():
+        snapshot = Snapshot(1, {'A': [Fortigate(f"fw-{i}", '10.0.0.1') for i in range(10)]})
+        return await asyncio.gather(*[snapshot.render('names', render_function, encoding)
+                                      for encoding in [None, 'gzip'] * 5])
+
+    monkeypatch.setattr(snapshot_module, 'compress_chunks', counting_compress)
+    results = asyncio.run(run())
+
+    assert len(renders) == 1
+    assert compressions == ['gzip']
+    assert {chunks_etag for _, chunks_etag in results[::2]} == {results[0][1]}
+    assert gzip.decompress(b''.join(results[1][0])) == b''.join(results[0][0])
+    assert results[0][1] != results[1][1]
+
+
+def test_failed_render_is_done_again():
+    calls = []
+
+    async def render_function(_):
+        calls.append(1)
+        if len(calls) == 1:
+            raise ValueError("failed")
+        return [b'body']
+
+    async def run():
+        snapshot = Snapshot(1, {})
+        with pytest.raises(ValueError):
+            await snapshot.render('body', render_function)
+        return await snapshot.render('body', render_function)
+
+    assert asyncio.run(run())[0] == [b'body']
+    assert len(calls) == 2
+
+
+def test_filter_on_any_discovery_label():
+    fws = {'A': [Fortigate('fw-1', '10.0.0.1', fmg='emea', sn='FGT1', labels={'__meta_fortigate_zone': 'z1'}),
+                 Fortigate('fw-2', '10.0.0.2', fmg='apac', sn='FGT2', labels={'__meta_fortigate_zone': 'z2'})]}
+    snapshot = Snapshot(1, fws)
+
+    for labels, names in [(['fmg=emea'], ['fw-1']), (['sn=FGT2'], ['fw-2']), (['name=fw-2'], ['fw-2']),
+                          (['zone=z1'], ['fw-1']), (['__meta_fortigate_fmg=apac', 'zone=z1'], [])]:
+        filtered = snapshot.filter(normalize_query({}, labels))
+        assert [fw.name for fw in filtered.fws['A']] == names